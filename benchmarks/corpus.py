@@ -0,0 +1,181 @@
+""" Generate a synthetic corpus of hOCR books for benchmarking.
+
+    python -m benchmarks.corpus /tmp/corpus --books 100 --pages 50
+
+Books are written either with an `image` and `bbox` on every `ocr_page`, or
+in the layout of the Google 1000 Books dataset (`<book>/hOCR.html` with the
+page images next to it as `Image_0000.JPEG` and no page dimensions in the
+hOCR). Words are drawn from a vocabulary of pseudo-words with a Zipf
+distribution, so there are a few very frequent terms and a long tail of
+rare ones. The same arguments always produce the same corpus.
+"""
+import bisect
+import itertools
+import os
+import random
+import shutil
+from pathlib import Path
+
+import click
+from PIL import Image
+
+LAYOUTS = ('bbox', 'google', 'mixed')
+SYLLABLES = ['ba', 'ke', 'li', 'mo', 'nu', 'ra', 'se', 'ti', 'vo', 'za',
+             'dor', 'fen', 'gal', 'hin', 'jus', 'lum', 'mar', 'nor', 'pel',
+             'quin', 'ros', 'sta', 'tur', 'ven', 'wil', 'xan']
+#: Name of the page image all pages are linked to, it is not an `.html`
+#: file, so it is not picked up as a book
+TEMPLATE_IMAGE = 'page-template.jpg'
+PAGE_MARGIN = 100
+#: Number of characters per word the width of a line is laid out for
+CHARS_PER_WORD = 12
+
+
+def make_vocabulary(size, rand):
+    """ Generate `size` distinct pseudo-words. """
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rand.choice(SYLLABLES)
+                          for _ in range(rand.randint(1, 4))))
+    return sorted(words)
+
+
+class WordSampler(object):
+    def __init__(self, vocabulary, rand, exponent=1.0):
+        """ Draw words with a Zipf distribution, the word at rank `k` has a
+        probability proportional to `1 / k**exponent`.
+
+        The order of the ranks is shuffled, so frequent words are not the
+        alphabetically first ones.
+        """
+        self.words = list(vocabulary)
+        rand.shuffle(self.words)
+        self.cum_weights = list(itertools.accumulate(
+            1 / (rank ** exponent) for rank in range(1, len(self.words) + 1)))
+
+    def __call__(self, rand):
+        point = rand.random() * self.cum_weights[-1]
+        return self.words[bisect.bisect(self.cum_weights, point)]
+
+
+def book_layout(layout, book_idx):
+    if layout == 'mixed':
+        return LAYOUTS[book_idx % 2]
+    return layout
+
+
+def get_book_id(book_idx):
+    return 'book_{:06}'.format(book_idx)
+
+
+def _link_image(template, path):
+    try:
+        os.link(str(template), str(path))
+    except OSError:
+        shutil.copyfile(str(template), str(path))
+
+
+def write_book(directory, book_idx, layout, num_pages, num_lines, num_words,
+               sample_word, rand, image_size, template):
+    """ Write a single book.
+
+    :param directory:   Corpus directory
+    :param layout:      'bbox' or 'google'
+    :param sample_word: Callable that returns a random word
+    :param template:    Page image that is linked for every page
+    :returns:           Path of the hOCR file
+    """
+    book_id = get_book_id(book_idx)
+    if layout == 'google':
+        img_dir = directory / book_id
+        hocr_path = img_dir / 'hOCR.html'
+    else:
+        img_dir = directory / (book_id + '_images')
+        hocr_path = directory / (book_id + '.html')
+    img_dir.mkdir(exist_ok=True)
+    width, height = image_size
+    # Spread the lines over the page
+    line_height = max(2, (height - 2 * PAGE_MARGIN) // num_lines)
+    char_width = max(1, (width - 2 * PAGE_MARGIN) //
+                     (num_words * CHARS_PER_WORD))
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<html xmlns="http://www.w3.org/1999/xhtml">\n'
+             '<head><title>{}</title></head>\n<body>\n'.format(book_id)]
+    for page_num in range(num_pages):
+        if layout == 'google':
+            img_name = 'Image_{:04}.JPEG'.format(page_num)
+            title = 'ppageno {}'.format(page_num)
+        else:
+            img_name = 'page_{:04}.jpg'.format(page_num)
+            title = 'ppageno {}; image {}/{}; bbox 0 0 {} {}'.format(
+                page_num, img_dir.name, img_name, width, height)
+        _link_image(template, img_dir / img_name)
+        parts.append('<div class="ocr_page" id="page_{:04}" title="{}">\n'
+                     .format(page_num, title))
+        for line_num in range(num_lines):
+            y = PAGE_MARGIN + line_num * line_height
+            x = PAGE_MARGIN
+            spans = []
+            for _ in range(rand.randint(max(1, num_words // 2), num_words)):
+                word = sample_word(rand)
+                word_width = len(word) * char_width
+                spans.append(
+                    '<span class="ocr_cinfo" title="bbox {} {} {} {}">{}'
+                    '</span>'.format(x, y, x + word_width,
+                                     y + line_height * 3 // 4, word))
+                x += word_width + char_width
+            parts.append('<span class="ocr_line" title="bbox {} {} {} {}">{}'
+                         '</span>\n'.format(PAGE_MARGIN, y, x,
+                                            y + line_height * 3 // 4,
+                                            ' '.join(spans)))
+        parts.append('</div>\n')
+    parts.append('</body>\n</html>\n')
+    hocr_path.write_text(''.join(parts), encoding='utf8')
+    return hocr_path
+
+
+def write_corpus(directory, books, pages=50, lines=30, words=10,
+                 vocabulary=5000, layout='mixed', seed=0,
+                 image_size=(1000, 1500), first_book=0):
+    """ Write the books `first_book` to `books - 1` of a corpus.
+
+    Every book is generated from its own seed, so a corpus can be grown
+    in steps and still be identical to one written at once.
+
+    :type directory:    :py:class:`pathlib.Path`
+    :returns:           Paths of the hOCR files that were written
+    """
+    if not directory.exists():
+        directory.mkdir(parents=True)
+    template = directory / TEMPLATE_IMAGE
+    if not template.exists():
+        Image.new('L', image_size, 255).save(str(template))
+    sample_word = WordSampler(
+        make_vocabulary(vocabulary, random.Random(seed)), random.Random(seed))
+    paths = []
+    for book_idx in range(first_book, books):
+        rand = random.Random('{}-{}'.format(seed, book_idx))
+        paths.append(write_book(
+            directory, book_idx, book_layout(layout, book_idx), pages, lines,
+            words, sample_word, rand, image_size, template))
+    return paths
+
+
+@click.command()
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--books', default=100, help="Number of books")
+@click.option('--pages', default=50, help="Pages per book")
+@click.option('--lines', default=30, help="Lines per page")
+@click.option('--words', default=10, help="Maximum number of words per line")
+@click.option('--vocabulary', default=5000, help="Number of distinct words")
+@click.option('--layout', type=click.Choice(LAYOUTS), default='mixed',
+              help="Page layout, 'mixed' alternates between both")
+@click.option('--seed', default=0, help="Seed for the random generator")
+def main(directory, books, pages, lines, words, vocabulary, layout, seed):
+    paths = write_corpus(Path(directory), books, pages, lines, words,
+                         vocabulary, layout, seed)
+    click.echo("Wrote {} books to {}".format(len(paths), directory))
+
+
+if __name__ == '__main__':
+    main()
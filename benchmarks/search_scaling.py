@@ -0,0 +1,102 @@
+""" Measure how search latency inside a single book depends on the number
+of books in the database.
+
+    python -m benchmarks.search_scaling --sizes 100,1000,10000,100000
+"""
+import json
+import random
+import tempfile
+import timeit
+from pathlib import Path
+
+import click
+
+from index import DatabaseRepository, DocumentRows
+
+#: Query used by the search endpoint before the index was scoped by rowid
+DOCUMENT_ID_FILTER = """
+    SELECT page_id, highlight(text_idx, 0, '<hi>', '</hi>'), word_infos,
+           rank as score
+    FROM text_idx
+    WHERE text_idx MATCH :query AND document_id = :document_id
+    ORDER BY score
+    LIMIT :limit;
+"""
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipisici',
+         'elit', 'sed', 'eiusmod', 'tempor', 'incidunt', 'labore', 'dolore',
+         'magna', 'aliqua', 'veniam', 'quis', 'nostrud', 'exercitation']
+
+
+def make_book(document_id, num_pages, lines_per_page, rand):
+    document = {'document_id': document_id,
+                'filename': document_id + '.html',
+                'metadata': json.dumps({'title': document_id}),
+                'file_size': None, 'file_mtime': None, 'file_hash': None}
+    pages = []
+    lines = []
+    for page_num in range(num_pages):
+        page_id = 'page_{:04}'.format(page_num)
+        pages.append({'document_id': document_id, 'page_id': page_id,
+                      'img_path': None, 'img_md5': None, 'img_mtime': None,
+                      'img_width': 2000, 'img_height': 3000})
+        for position in range(lines_per_page):
+            words = [rand.choice(WORDS) for _ in range(8)]
+            cuts = ' '.join('{}:{}:{}'.format(idx, idx * 200, idx * 200 + 180)
+                            for idx in range(len(words)))
+            lines.append({'document_id': document_id, 'page_id': page_id,
+                          'position': position, 'text': ' '.join(words),
+                          'pos_x': 100, 'pos_y': 100 + position * 40,
+                          'width': 1800, 'height': 30, 'word_cuts': cuts})
+    return DocumentRows(document, pages, lines)
+
+
+def time_query(func, repeat):
+    func()
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+@click.command()
+@click.option('--sizes', default='100,1000,10000',
+              help="Comma-separated numbers of books to measure at")
+@click.option('--pages', default=20, help="Pages per book")
+@click.option('--lines', default=10, help="Lines per page")
+@click.option('--query', default='dolor', help="Term to search for")
+@click.option('--repeat', default=20, help="Repetitions per measurement")
+@click.option('--db-path', type=click.Path(dir_okay=False),
+              help="Database to build, defaults to a temporary file")
+def main(sizes, pages, lines, query, repeat, db_path):
+    sizes = sorted(int(s) for s in sizes.split(','))
+    if db_path is None:
+        db_path = str(Path(tempfile.mkdtemp()) / 'bench.db')
+    # Measure the search queries, not reading their results from the cache
+    repo = DatabaseRepository(Path(db_path), search_cache_size=0)
+    rand = random.Random(0)
+    target = 'book_00000000'
+    results = []
+    num_books = 0
+    for size in sizes:
+        while num_books < size:
+            repo.store_document(
+                make_book('book_{:08}'.format(num_books), pages, lines, rand),
+                autocomplete_min_count=1)
+            num_books += 1
+
+        def scoped():
+            list(repo.search(query, target))
+
+        def filtered():
+            with repo._db as cur:
+                cur.execute(DOCUMENT_ID_FILTER, {
+                    'query': query, 'document_id': target,
+                    'limit': 50}).fetchall()
+
+        result = {'books': num_books,
+                  'scoped_ms': round(time_query(scoped, repeat), 3),
+                  'document_id_filter_ms': round(time_query(filtered, repeat),
+                                                 3)}
+        results.append(result)
+        click.echo(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
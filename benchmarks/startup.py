@@ -0,0 +1,62 @@
+""" Time how long the command line interface takes to start.
+
+    python -m benchmarks.startup --repeat 20
+
+Every command is run in a fresh interpreter, so the time includes starting
+Python and importing the modules the command needs:
+
+- `help`: `hocrviewer.py --help`
+- `index`: `hocrviewer.py index` without any files, i.e. the overhead of
+  every ingest job
+- `import_webapp`: importing the web application, which only `serve`,
+  `pretile` and `export` do
+"""
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from benchmarks.suite import summarize
+
+#: Directory with the modules of the application
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def time_command(args, repeat):
+    """ Run a command `repeat` times after a warm-up run.
+
+    :returns:   Summary of the wall clock times, see
+                :py:func:`benchmarks.suite.summarize`
+    """
+    timings = []
+    for run in range(repeat + 1):
+        start = time.perf_counter()
+        subprocess.check_call(args, cwd=str(ROOT_DIR),
+                              stdout=subprocess.DEVNULL)
+        if run:
+            timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+@click.command()
+@click.option('--repeat', default=20, help="Runs per command")
+def main(repeat):
+    work_dir = Path(tempfile.mkdtemp(prefix='hocrviewer-startup-'))
+    script = str(ROOT_DIR / 'hocrviewer.py')
+    commands = (
+        ('help', [sys.executable, script, '--help']),
+        ('index', [sys.executable, script,
+                   '--db-path', str(work_dir / 'startup.db'), 'index']),
+        ('import_webapp', [sys.executable, '-c', 'import webapp']))
+    for variant, args in commands:
+        result = time_command(args, repeat)
+        result.update(benchmark='startup', variant=variant)
+        click.echo(json.dumps(result, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
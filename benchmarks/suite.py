@@ -0,0 +1,256 @@
+""" Time ingest and the serving code paths at several corpus sizes.
+
+    python -m benchmarks.suite run --sizes 10,100 --output new.json
+    python -m benchmarks.suite compare old.json new.json
+
+A synthetic corpus (see :py:mod:`benchmarks.corpus`) is grown to every size
+in turn and ingested into a database. Then the following are measured on
+the first book:
+
+- `ingest`: :py:meth:`DatabaseRepository.ingest_document`, per book that
+  was added for this size
+- `read_document`: :py:meth:`FilesystemRepository._read_document`, when
+  the hOCR has to be parsed, when it is read from the disk cache and when it
+  is already in memory
+- `manifest` and `annotation_list`: the responses of both endpoints, for
+  both repositories
+- `search` and `autocomplete`: the repository methods, for a frequent and
+  an infrequent term and for prefixes of different lengths. Searches don't
+  use the search results cache, except for the `cached` variant.
+
+Every result is printed as a JSON line. With `--output`, all of them are
+written to a file together with the versions and parameters they were
+measured with, which `compare` reads.
+"""
+import json
+import logging
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+import webapp
+from benchmarks.corpus import (WordSampler, get_book_id, make_vocabulary,
+                               write_corpus)
+from cache import DiskCache
+from index import DatabaseRepository, FilesystemRepository
+
+#: Rank of the term searched for in the `infrequent` search benchmark
+INFREQUENT_RANK = 100
+#: Prefix lengths measured for autocomplete
+PREFIX_LENGTHS = (1, 3, 5)
+
+
+def summarize(timings):
+    """ :param timings: Durations in seconds
+    :returns:           Number of runs, minimum and median in milliseconds
+    """
+    return {'runs': len(timings),
+            'min_ms': round(min(timings) * 1000, 3),
+            'median_ms': round(statistics.median(timings) * 1000, 3)}
+
+
+def measure(func, repeat, setup=None):
+    """ Time `func` after a warm-up call.
+
+    :param setup:   Called before every run, its return value is passed to
+                    `func` and the time it takes is not measured
+    """
+    timings = []
+    for run in range(repeat + 1):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        if run:
+            timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=str(Path(__file__).parent), stderr=subprocess.DEVNULL
+        ).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fetch(client, url):
+    resp = client.get(url)
+    data = resp.get_data()
+    resp.close()
+    if resp.status_code != 200:
+        raise click.ClickException(
+            "{} returned {}".format(url, resp.status_code))
+    return data
+
+
+def run_benchmarks(work_dir, sizes, params, repeat, echo):
+    corpus_dir = work_dir / 'corpus'
+    # Measure the search queries, not reading their results from the cache
+    db_repo = DatabaseRepository(work_dir / 'bench.db', search_cache_size=0)
+    cached_repo = DatabaseRepository(work_dir / 'bench.db')
+    client = webapp.app.test_client()
+    # Measure building the manifests, not reading them from the cache
+    webapp.manifest_cache = None
+    sampler = WordSampler(
+        make_vocabulary(params['vocabulary'], random.Random(params['seed'])),
+        random.Random(params['seed']))
+    terms = {'frequent': sampler.words[0],
+             'infrequent': sampler.words[min(INFREQUENT_RANK,
+                                             len(sampler.words) - 1)]}
+    prefix_term = max(sampler.words[:10], key=len)
+    book_id = get_book_id(0)
+    page_id = 'page_0000'
+    num_books = 0
+    for size in sizes:
+        def result(benchmark, variant, **values):
+            values.update(benchmark=benchmark, variant=variant, books=size)
+            echo(values)
+
+        paths = write_corpus(corpus_dir, size, first_book=num_books,
+                             **params)
+        timings = []
+        for path in paths:
+            start = time.perf_counter()
+            db_repo.ingest_document(path, autocomplete_min_count=1)
+            timings.append(time.perf_counter() - start)
+        num_books = size
+        result('ingest', 'database', **summarize(timings))
+
+        def fresh_repository(cache=None):
+            repo = FilesystemRepository(corpus_dir, cache=cache)
+            repo.document_count()
+            return repo
+
+        disk_cache = DiskCache(work_dir / 'documents')
+        disk_cache.flush()
+        fresh_repository(disk_cache)._read_document(book_id)
+        fs_repo = fresh_repository()
+        read = (lambda repo: repo._read_document(book_id))
+        result('read_document', 'parse',
+               **measure(read, repeat, setup=fresh_repository))
+        result('read_document', 'disk_cache',
+               **measure(read, repeat,
+                         setup=lambda: fresh_repository(disk_cache)))
+        result('read_document', 'memory',
+               **measure(lambda: fs_repo._read_document(book_id), repeat))
+
+        for name, repo in (('database', db_repo), ('filesystem', fs_repo)):
+            webapp.repository = repo
+            result('manifest', name, **measure(
+                lambda: fetch(client, '/iiif/' + book_id), repeat))
+            result('annotation_list', name, **measure(
+                lambda: fetch(client, '/iiif/{}/list/{}'.format(
+                    book_id, page_id)), repeat))
+
+        for variant, term in sorted(terms.items()):
+            result('search', variant, **measure(
+                lambda: list(db_repo.search(term, book_id)), repeat))
+        result('search', 'cached', **measure(
+            lambda: list(cached_repo.search(terms['frequent'], book_id)),
+            repeat))
+        for length in PREFIX_LENGTHS:
+            prefix = prefix_term[:length]
+            result('autocomplete', 'prefix_{}'.format(length), **measure(
+                lambda: db_repo.autocomplete(prefix, book_id), repeat))
+
+
+@click.group()
+def main():
+    logging.disable(logging.WARNING)
+
+
+@main.command('run')
+@click.option('--sizes', default='10,100',
+              help="Comma-separated numbers of books to measure at")
+@click.option('--pages', default=20, help="Pages per book")
+@click.option('--lines', default=25, help="Lines per page")
+@click.option('--words', default=10, help="Maximum number of words per line")
+@click.option('--vocabulary', default=5000, help="Number of distinct words")
+@click.option('--seed', default=0, help="Seed for the corpus generator")
+@click.option('--repeat', default=10, help="Repetitions per measurement")
+@click.option('--work-dir', type=click.Path(file_okay=False),
+              help="Directory for the corpus, database and caches, defaults "
+                   "to a temporary directory. Must not contain a previous "
+                   "run.")
+@click.option('--output', type=click.Path(dir_okay=False),
+              help="File to write all results to as JSON")
+def run(sizes, pages, lines, words, vocabulary, seed, repeat, work_dir,
+        output):
+    sizes = sorted(int(s) for s in sizes.split(','))
+    params = {'pages': pages, 'lines': lines, 'words': words,
+              'vocabulary': vocabulary, 'seed': seed}
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='hocrviewer-bench-')
+    work_dir = Path(work_dir)
+    if not work_dir.exists():
+        work_dir.mkdir(parents=True)
+    results = []
+
+    def echo(result):
+        results.append(result)
+        click.echo(json.dumps(result, sort_keys=True))
+
+    run_benchmarks(work_dir, sizes, params, repeat, echo)
+    if output is not None:
+        report = {
+            'meta': {
+                'revision': get_revision(),
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'parameters': dict(params, sizes=sizes, repeat=repeat)},
+            'results': results}
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+
+@main.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('candidate', type=click.File())
+@click.option('--fail-above', type=float,
+              help="Exit with an error if any median got slower by more "
+                   "than this factor, e.g. 1.2")
+def compare(baseline, candidate, fail_above):
+    """ Compare the medians of two result files. """
+    def load(fp):
+        report = json.load(fp)
+        return report['meta'], {
+            (r['benchmark'], r['variant'], r['books']): r
+            for r in report['results']}
+    old_meta, old = load(baseline)
+    new_meta, new = load(candidate)
+    if old_meta['parameters'] != new_meta['parameters']:
+        click.echo("Warning: the results were measured with different "
+                   "parameters", err=True)
+    click.echo('{:<16} {:<12} {:>7} {:>11} {:>11} {:>8}'.format(
+        'benchmark', 'variant', 'books', old_meta['revision'] or 'baseline',
+        new_meta['revision'] or 'candidate', 'change'))
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        old_ms = old[key]['median_ms']
+        new_ms = new[key]['median_ms']
+        ratio = new_ms / old_ms if old_ms else float('inf')
+        if fail_above is not None and ratio > fail_above:
+            regressions += 1
+        click.echo('{:<16} {:<12} {:>7} {:>9.3f}ms {:>9.3f}ms {:>+7.1f}%'
+                   .format(key[0], key[1], key[2], old_ms, new_ms,
+                           (ratio - 1) * 100))
+    if regressions:
+        click.echo("{} measurements got slower by more than {}x"
+                   .format(regressions, fail_above), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
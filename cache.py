@@ -0,0 +1,278 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class DiskCache(object):
+    #: Share of the size limit a process can write before it checks the size
+    #: of the cache again
+    CHECK_INTERVAL = 0.05
+    #: Share of the size limit the cache is shrunk to when it is exceeded
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, directory, max_bytes=None):
+        """ Key-value store for serialized responses on the local disk.
+
+        Entries are written atomically, so a cache directory can be shared
+        by all worker processes on a host.
+
+        If a size limit is set, every read updates the access time of the
+        entry, and the least recently used entries are removed when the
+        cache grows beyond the limit. Since every process only checks the
+        size after it wrote `CHECK_INTERVAL` of the limit, the limit can be
+        exceeded by that much per process in between.
+
+        :param directory:   Directory to store the entries in, will be
+                            created if it does not exist
+        :type directory:    :py:class:`pathlib.Path`
+        :param max_bytes:   Size limit for all entries, unbounded if `None`
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._written = None
+        self._lock = threading.Lock()
+
+    def _get_path(self, key):
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return self.directory / digest[:2] / digest[2:]
+
+    def _touch(self, path, fp):
+        if self.max_bytes is None:
+            return
+        try:
+            os.utime(str(path), (time.time(), os.fstat(fp.fileno()).st_mtime))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """ Get the value stored for `key`.
+
+        :returns:   The stored value or `None` if there is no entry
+        :rtype:     bytes
+        """
+        path = self._get_path(key)
+        try:
+            with path.open('rb') as fp:
+                self._touch(path, fp)
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def map(self, key):
+        """ Memory-map the value stored for `key`.
+
+        :returns:   A read-only map of the stored value or `None` if there
+                    is no entry
+        :rtype:     :py:class:`mmap.mmap`
+        """
+        path = self._get_path(key)
+        try:
+            with path.open('rb') as fp:
+                self._touch(path, fp)
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # mmap raises ValueError for empty files
+            return None
+
+    def get_mtime(self, key):
+        """ Get the time `key` was last written.
+
+        :returns:   Timestamp or `None` if there is no entry
+        """
+        try:
+            return self._get_path(key).stat().st_mtime
+        except OSError:
+            return None
+
+    def set(self, key, value):
+        """ Store `value` under `key`.
+
+        :type value:    bytes
+        """
+        write_atomic(self._get_path(key), value)
+        if self.max_bytes is not None:
+            self._account(len(value))
+
+    @contextmanager
+    def writer(self, key):
+        """ Store the value for `key` piece by piece.
+
+        Yields a file object to write the value to. The entry only becomes
+        visible when the block is left without an exception, otherwise it is
+        discarded.
+        """
+        with open_atomic(self._get_path(key)) as fp:
+            yield fp
+            nbytes = fp.tell()
+        if self.max_bytes is not None:
+            self._account(nbytes)
+
+    def delete(self, key):
+        try:
+            self._get_path(key).unlink()
+        except OSError:
+            pass
+
+    def _account(self, nbytes):
+        with self._lock:
+            if (self._written is not None and
+                    self._written + nbytes <
+                    self.max_bytes * self.CHECK_INTERVAL):
+                self._written += nbytes
+                return
+            self._written = 0
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries if the cache is larger
+        than its size limit, until it is down to `LOW_WATERMARK` of it.
+        """
+        entries = []
+        total = 0
+        for parent in _scandir(str(self.directory)):
+            if not parent.is_dir():
+                continue
+            for entry in _scandir(parent.path):
+                if entry.name.startswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes * self.LOW_WATERMARK:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def flush(self):
+        """ Remove all entries. """
+        for parent in _scandir(str(self.directory)):
+            if not parent.is_dir():
+                continue
+            for entry in _scandir(parent.path):
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+
+@contextmanager
+def open_atomic(path):
+    """ Open a temporary file for writing that replaces `path` when the
+    block is left, so that readers only ever see the complete file. If the
+    block raises, `path` is left untouched.
+
+    The parent directories are created if they don't exist.
+
+    :type path:     :py:class:`pathlib.Path`
+    """
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            yield fp
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_atomic(path, data):
+    """ Write `data` to `path` with :py:func:`open_atomic`.
+
+    :type path:     :py:class:`pathlib.Path`
+    :type data:     bytes
+    """
+    with open_atomic(path) as fp:
+        fp.write(data)
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except OSError:
+        return []
+
+
+class MemoryCache(object):
+    def __init__(self, max_bytes):
+        """ Least recently used cache that is bounded by the estimated size
+        of its values instead of their number.
+
+        Counts hits, misses and evictions, see :py:meth:`stats`.
+
+        :param max_bytes:   Budget for the sizes of all values
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Get the value stored for `key` and mark it as recently used.
+
+        :returns:   The value or `default` if there is no entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        """ Store `value` under `key`, evicting the least recently used
+        entries until the cache is within its budget again.
+
+        Values larger than the whole budget are not stored.
+
+        :param size:    Estimated size of the value in bytes
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """ Get the counters and current size of the cache.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes}
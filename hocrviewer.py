@@ -1,302 +1,40 @@
 from __future__ import print_function
 
-import functools
 import logging
 import pathlib
-from collections import namedtuple
-from itertools import chain
-from multiprocessing import cpu_count
+import time
+import traceback
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
 import click
 import click_log
-import flask
-import gunicorn.app.base
-from flask_iiif import IIIF
-from flask_iiif.cache.simple import ImageSimpleCache
-from flask_restful import Api
-from iiif_prezi.factory import ManifestFactory
 
-from index import DatabaseRepository, FilesystemRepository
+from cache import DiskCache
+from index import (CATALOG_RESCAN_INTERVAL, DOCUMENT_CACHE_SIZE,
+                   SEARCH_CACHE_SIZE, DatabaseRepository, FilesystemRepository,
+                   extract_document, fingerprint_file, get_doc_id)
 
-SearchHit = namedtuple("SearchHit",
-                       ("match", "before", "after", "annotations"))
+#: gunicorn worker types that can be selected for `serve`
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
 
-
-app = flask.Flask('hocrviewer', static_folder='./vendor/mirador',
-                  static_url_path='/static')
-ext = IIIF(app=app)
-api = Api(app=app)
-ext.init_restful(api, prefix="/iiif/image/")
 repository = None
 logger = logging.getLogger(__name__)
 
 
-class ApiException(Exception):
-    status_code = 500
-
-    def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
-        self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
-
-    def to_dict(self):
-        rv = dict(self.payload or ())
-        rv['message'] = self.message
-        return rv
-
-
-@app.errorhandler(ApiException)
-def handle_api_exception(error):
-    response = flask.jsonify(error.to_dict())
-    response.status_code = error.status_code
-    return response
-
-
-def cors(origin='*'):
-    """This decorator adds CORS headers to the response"""
-    def decorator(f):
-        @functools.wraps(f)
-        def decorated_function(*args, **kwargs):
-            resp = flask.make_response(f(*args, **kwargs))
-            h = resp.headers
-            h['Access-Control-Allow-Origin'] = origin
-            return resp
-        return decorated_function
-    return decorator
-
-
-def locate_image(uid):
-    book_id, page_id = uid.split(':')
-    return repository.get_image_path(book_id, page_id)
-
-
-class HocrViewerApplication(gunicorn.app.base.BaseApplication):
-    def __init__(self, app):
-        self.options = {'bind': '0.0.0.0:5000',
-                        'workers': cpu_count()*2+1}
-        self.application = app
-        app.config['IIIF_CACHE_HANDLER'] = ImageSimpleCache()
-        ext.uuid_to_image_opener_handler(locate_image)
-        super(HocrViewerApplication, self).__init__()
-
-    def load_config(self):
-        config = dict([(key, value) for key, value in self.options.items()
-                       if key in self.cfg.settings and value is not None])
-        for key, value in config.items():
-            self.cfg.set(key.lower(), value)
-
-    def load(self):
-        return self.application
-
-
-def build_manifest(book_id, book_path, metadata, pages):
-    fac = ManifestFactory()
-    base_url = flask.request.url_root[:-1]
-    fac.set_base_prezi_uri(
-        base_url + flask.url_for('get_book_manifest', book_id=book_id))
-    fac.set_base_image_uri(base_url + '/iiif/image/v2')
-    fac.set_iiif_image_info(2.0, 2)
-    manifest = fac.manifest(label=book_id)
-    manifest.set_description("Automatically generated from HOCR")
-    seq = manifest.sequence(ident='0')
-    for idx, (page_id, img_path, width, height) in enumerate(pages):
-        canvas = seq.canvas(ident=page_id,
-                            label='Page {}'.format(idx))
-        anno = canvas.annotation(ident=page_id)
-        img = anno.image('{}:{}'.format(book_id, page_id), iiif=True)
-        img.set_hw(height, width)
-        canvas.height = img.height
-        canvas.width = img.width
-        canvas.annotationList(
-            base_url + flask.url_for('get_page_lines', book_id=book_id,
-                                     page_id=page_id),
-            label="Transcribed Text")
-    if not seq.canvases:
-        logger.error("{} has no images!".format(book_path))
-        return None
-    else:
-        return manifest
-
-
-def get_canvas_id(book_id, page_id):
-    base_url = flask.request.url_root[:-1]
-    return (base_url + flask.url_for('get_book_manifest', book_id=book_id) +
-            '/canvas/' + page_id)
-
-
-@app.route("/iiif/<book_id>")
-@cors('*')
-def get_book_manifest(book_id):
-    doc = repository.get_document(book_id)
-    if not doc:
-        raise ApiException(
-            "Could not find book with id '{}'".format(book_id), 404)
-    pages = repository.get_pages(book_id)
-    manifest = build_manifest(*doc, pages=pages)
-    if manifest is None:
-        raise ApiException(
-            "Could not build manifest for book with id '{}'"
-            .format(book_id), 404)
-    if isinstance(repository, DatabaseRepository):
-        manifest.add_service(
-            ident=(flask.request.base_url +
-                   flask.url_for('search_in_book', book_id=book_id)),
-            context='http://iiif.io/api/search/1/context.json',
-            profile='http://iiif.io/api/search/1/search')
-    return flask.jsonify(manifest.toJSON(top=True))
-
-
-@app.route("/iiif/<book_id>/list/<page_id>", methods=['GET'])
-@app.route("/iiif/<book_id>/list/<page_id>.json", methods=['GET'])
-@cors('*')
-def get_page_lines(book_id, page_id):
-    lines = repository.get_lines(book_id, page_id)
-    if lines is None:
-        raise ApiException(
-            "Could not find lines for page '{}' in book '{}'"
-            .format(page_id, book_id), 404)
-    fac = ManifestFactory()
-    fac.set_base_prezi_uri(
-        flask.request.url_root[:-1] + '/iiif/' + book_id + '/' + page_id)
-    annotation_list = fac.annotationList(ident=book_id + '/' + page_id)
-    # FIXME: Workaround for a really stupid bug in iiif-prezi:
-    # The library sets .resources as a class-attribute, which is why:
-    #   - it will not get serialized during toJSON
-    #   - multiple instances share their resources
-    annotation_list.resources = []
-    for idx, (text, x, y, w, h) in enumerate(lines):
-        anno = annotation_list.annotation(ident='line-{}'.format(idx))
-        anno.text(text=text)
-        anno.on = (get_canvas_id(book_id, page_id) +
-                   "#xywh={},{},{},{}".format(x, y, w, h))
-    out_data = annotation_list.toJSON(top=True)
-    if not annotation_list.resources:
-        # NOTE: iiif-prezi strips empty lists from the resulting JSON,
-        #       so we have to add the empty list ourselves...
-        out_data['resources'] = []
-    return flask.jsonify(out_data)
-
-
-@app.route("/iiif/<book_id>/search", methods=['GET'])
-@cors('*')
-def search_in_book(book_id):
-    if not isinstance(repository, DatabaseRepository):
-        raise ApiException(
-                "Searching is only supported if the content has been indexed. "
-                "Please run `hocrviewer index` to do so.", 501)
-    base_url = flask.request.url_root[:-1]
-    query = flask.request.args.get('q')
-    out = {
-        '@context': [
-            'http://iiif.io/api/presentation/2/context.json',
-            'http://iiif.io/api/search/1/context.json'],
-        '@id': (base_url + flask.url_for('search_in_book',
-                                         book_id=book_id) + '?q=' + query),
-        '@type': 'sc:AnnotationList',
-
-        'within': {
-            '@type': 'sc:Layer',
-            'ignored': [k for k in flask.request.args.keys() if k != 'q']
-        },
-
-        'resources': [],
-        'hits': []}
-
-    for page_id, match_text, line_infos in repository.search(query, book_id):
-        match_text = match_text.split()
-        start_idxs = [idx for idx, word in enumerate(match_text)
-                      if "<hi>" in word]
-        end_idxs = [idx for idx, word in enumerate(match_text)
-                    if "</hi>" in word]
-        for start_idx, end_idx in zip(start_idxs, end_idxs):
-            match = " ".join(match_text[start_idx:end_idx+1])
-            match = match.replace("<hi>", "").replace("</hi>", "")
-            before = "..." + " ".join(
-                match_text[max(0, start_idx-8):start_idx]),
-            after = " ".join(match_text[end_idx+1:end_idx+9]) + "..."
-            hit = SearchHit(match=match, before=before, after=after,
-                            annotations=[])
-            match_words = chain.from_iterable(
-                ((match_text[w.sequence_pos], w.sequence_pos,
-                  w.start_x, l.y_pos, w.end_x - w.start_x, l.height)
-                 for w in winfos if start_idx <= w.sequence_pos <= end_idx)
-                for l, winfos in line_infos)
-            for chars, pos, x, y, w, h in match_words:
-                anno = {
-                    '@id': "/".join((get_canvas_id(book_id, page_id),
-                                     'words', str(pos))),
-                    '@type': 'oa:Annotation',
-                    'motivation': 'sc:Painting',
-                    'resource': {
-                        '@type': 'cnt:ContentAsText',
-                        'chars': (chars.replace('<hi>', '')
-                                       .replace('</hi>', ''))},
-                    'on': (get_canvas_id(book_id, page_id) +
-                           "#xywh={},{},{},{}".format(x, y, w, h))}
-                hit.annotations.append(anno['@id'])
-                out['resources'].append(anno)
-            out['hits'].append({
-                '@type': 'sc:Hit',
-                'annotations': hit.annotations,
-                'match': hit.match,
-                'before': hit.before,
-                'after': hit.after})
-    return flask.jsonify(out)
-
-
-@app.route("/iiif/<book_id>/autocomplete", methods=['GET'])
-@cors('*')
-def autocomplete_in_book(book_id):
-    if not isinstance(repository, DatabaseRepository):
-        raise ApiException(
-                "Autocompletion is only supported if the content has been "
-                "indexed. Please run `hocrviewer index` to do so.", 501)
-    base_url = flask.request.url_root[:-1]
-    query = flask.request.args.get('q')
-    min_cnt = int(flask.request.args.get('min', '1'))
-    out = {
-        "@context": "http://iiif.io/api/search/1/context.json",
-        "@id": (base_url +
-                flask.url_for('autocomplete_in_book', book_id=book_id) +
-                "?q=" + query + ('&min=' + min_cnt if min_cnt > 1 else '')),
-        "@type": "search:TermList",
-        "ignored": [k for k in flask.request.args.keys()
-                    if k not in ('q', 'min')],
-        "terms": []}
-    for term, cnt in repository.autocomplete(query, book_id, min_cnt):
-        out['terms'].append({
-            'match': term,
-            'count': cnt,
-            'url': (base_url +
-                    flask.url_for('search_in_book', book_id=book_id) +
-                    '?q=' + term)})
-    return flask.jsonify(out)
-
-
-@app.route('/')
-def index():
-    return flask.render_template(
-        'index.html', book_ids=repository.document_ids())
-
-
-@app.route('/view/<book_id>')
-def view(book_id):
-    return flask.render_template(
-        'mirador.html',
-        manifest_uri=flask.url_for('get_book_manifest', book_id=book_id))
-
-
 @click.group()
 @click_log.simple_verbosity_option()
 @click.pass_context
 @click.option('-db', '--db-path', help='Target path for application database',
               type=click.Path(dir_okay=False, readable=True, writable=True),
               default=click.get_app_dir('hocrviewer') + '/hocrviewer.db')
-def cli(ctx, db_path):
+@click.option('--cache-dir', help='Directory for caching generated responses',
+              type=click.Path(file_okay=False, writable=True),
+              default=click.get_app_dir('hocrviewer') + '/cache')
+def cli(ctx, db_path, cache_dir):
     db_path = pathlib.Path(db_path)
     ctx.obj['DB_PATH'] = db_path
+    ctx.obj['CACHE_DIR'] = pathlib.Path(cache_dir)
     if db_path.exists():
         global repository
         repository = DatabaseRepository(db_path)
@@ -305,13 +43,141 @@ def cli(ctx, db_path):
 @cli.command('serve')
 @click.argument('base_directory', required=False,
                 type=click.Path(file_okay=False, exists=True, readable=True))
-def serve(base_directory):
+@click.option('--rescan-interval', type=float,
+              default=CATALOG_RESCAN_INTERVAL,
+              help="Seconds between checks of the base directory for new or "
+                   "removed books")
+@click.option('--document-cache-size', type=int,
+              default=DOCUMENT_CACHE_SIZE // 2**20,
+              help="Memory in MiB for parsed books in every worker process")
+@click.option('--search-cache-size', type=int,
+              default=SEARCH_CACHE_SIZE // 2**20,
+              help="Memory in MiB for search results in every worker "
+                   "process, only used when serving from a database")
+@click.option('--tile-cache-size', type=int, default=1024,
+              help="Disk space in MiB for rendered image tiles, shared by "
+                   "all worker processes")
+@click.option('--manifest-cache-size', type=int, default=256,
+              help="Disk space in MiB for serialized manifests, shared by "
+                   "all worker processes")
+@click.option('-b', '--bind', multiple=True, default=('0.0.0.0:5000',),
+              help="Address to listen on, can be given multiple times")
+@click.option('-w', '--workers', type=int, default=cpu_count()*2+1,
+              help="Number of worker processes")
+@click.option('-k', '--worker-class', default='sync',
+              type=click.Choice(WORKER_CLASSES),
+              help="Type of the workers: 'sync' handles one request at a "
+                   "time, 'gthread' runs a pool of `--threads` per process "
+                   "and 'gevent' serves from greenlets (requires gevent)")
+@click.option('--threads', type=int, default=1,
+              help="Threads per worker process, only used by 'gthread' "
+                   "workers, and by 'sync' workers that are switched to "
+                   "'gthread' if this is larger than 1")
+@click.option('--preload/--no-preload', default=False,
+              help="Load the application and scan the base directory once "
+                   "before forking the workers, which then share that "
+                   "memory")
+@click.option('--keepalive', type=int, default=2,
+              help="Seconds to keep idle client connections open, ignored "
+                   "by 'sync' workers")
+@click.option('--timeout', type=int, default=30,
+              help="Seconds after which a worker that is stuck on a request "
+                   "is killed and restarted")
+@click.pass_context
+def serve(ctx, base_directory, rescan_interval, document_cache_size,
+          search_cache_size, tile_cache_size, manifest_cache_size, bind,
+          workers, worker_class, threads, preload, keepalive, timeout):
+    if worker_class == 'gevent':
+        try:
+            import gevent  # noqa
+        except ImportError:
+            raise click.BadParameter(
+                "The 'gevent' workers need the gevent package to be "
+                "installed.", param_hint='--worker-class')
+    # The web stack is only imported by the commands that need it, so that
+    # the others start quickly
+    import metrics
+    import webapp
     global repository
     if repository is None:
         if base_directory is None:
             raise click.BadArgumentUsage("Please specify a base directory.")
-        repository = FilesystemRepository(pathlib.Path(base_directory))
-    HocrViewerApplication(app).run()
+        repository = FilesystemRepository(
+            pathlib.Path(base_directory), rescan_interval,
+            cache=DiskCache(ctx.obj['CACHE_DIR'] / 'documents'),
+            document_cache_size=document_cache_size * 2**20)
+    else:
+        repository = DatabaseRepository(
+            ctx.obj['DB_PATH'], search_cache_size=search_cache_size * 2**20)
+    webapp.repository = repository
+    # Manifests are cached per URL the application is reached under and
+    # per version of the book, so outdated entries have to be evicted
+    webapp.manifest_cache = DiskCache(
+        ctx.obj['CACHE_DIR'] / 'manifests',
+        max_bytes=manifest_cache_size * 2**20)
+    # Configured before the workers are forked, so they all share it
+    metrics.registry.configure(ctx.obj['CACHE_DIR'] / 'metrics')
+    metrics.registry.reset()
+    tile_cache = webapp.TileCache(
+        DiskCache(ctx.obj['CACHE_DIR'] / 'tiles',
+                  max_bytes=tile_cache_size * 2**20),
+        pyramid_dir=ctx.obj['CACHE_DIR'] / 'pyramid')
+    webapp.HocrViewerApplication(webapp.app, tile_cache, {
+        'bind': list(bind), 'workers': workers,
+        'worker_class': worker_class, 'threads': threads,
+        'preload_app': preload, 'keepalive': keepalive,
+        'timeout': timeout}).run()
+
+
+@cli.command('migrate')
+@click.option('--autocomplete-min-count', type=int, default=5,
+              help="Only store terms with at least this frequency for "
+                   "autocomplete, if the autocomplete data has to be rebuilt")
+@click.option('--vacuum/--no-vacuum', default=False,
+              help="Rebuild the database file afterwards to return the space "
+                   "freed by the migration to the file system")
+@click.pass_context
+def migrate(ctx, autocomplete_min_count, vacuum):
+    if repository is None:
+        raise click.BadParameter(
+            "No database found at {}".format(ctx.obj['DB_PATH']),
+            param_hint='--db-path')
+    repository.migrate(autocomplete_min_count)
+    if vacuum:
+        repository.vacuum()
+
+
+def _extract_rows(args):
+    """ Parse a document for ingest, returning a traceback instead of raising
+    so that failures can be reported per file from a worker process.
+
+    :param args:    `(hocr_path, known_hash)`, the document is not parsed if
+                    the content hash of the file is `known_hash`
+    :returns:       `(hocr_path, fingerprint, rows, traceback)`, `rows` is
+                    `None` if the document is unchanged
+    """
+    hocr_path, known_hash = args
+    try:
+        fingerprint = fingerprint_file(hocr_path)
+        if fingerprint.hash == known_hash:
+            return hocr_path, fingerprint, None, None
+        return (hocr_path, fingerprint,
+                extract_document(hocr_path, fingerprint), None)
+    except Exception:
+        return hocr_path, None, None, traceback.format_exc()
+
+
+def _imap_bounded(pool, func, items, window):
+    """ Like :py:meth:`multiprocessing.Pool.imap`, but keeps at most `window`
+    results in flight, so a slow consumer does not pile up parsed documents
+    in memory. """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 @cli.command('index')
@@ -321,25 +187,206 @@ def serve(base_directory):
               help="Only store terms with at least this frequency for "
                    "autocomplete (going from 5 to 1 doubles the database "
                    "size!)")
+@click.option('-j', '--jobs', type=int, default=1,
+              help="Number of processes used for parsing the hOCR files. "
+                   "The database is always written from a single process.")
+@click.option('--incremental', is_flag=True,
+              help="Skip books whose hOCR file has not changed since it was "
+                   "last indexed.")
 @click.pass_context
-def index_documents(ctx, hocr_files, autocomplete_min_count):
-    def show_fn(hocr_path):
-        if hocr_path is None:
+def index_documents(ctx, hocr_files, autocomplete_min_count, jobs,
+                    incremental):
+    def show_fn(result):
+        if result is None:
             return ''
         else:
-            return hocr_path.name
+            return result[0].name
     global repository
     if repository is None:
         repository = DatabaseRepository(ctx.obj['DB_PATH'])
 
     hocr_files = tuple(pathlib.Path(p) for p in hocr_files)
-    with click.progressbar(hocr_files, item_show_func=show_fn) as hocr_files:
-        for hocr_path in hocr_files:
-            try:
-                repository.ingest_document(hocr_path, autocomplete_min_count)
-            except Exception as e:
-                logger.error("Could not ingest {}".format(hocr_path))
-                logger.exception(e)
+    tasks = []
+    num_unchanged = 0
+    for hocr_path in hocr_files:
+        known = None
+        if incremental:
+            known = repository.get_fingerprint(get_doc_id(hocr_path))
+        if known is not None:
+            stat = hocr_path.stat()
+            if (stat.st_size, stat.st_mtime_ns) == (known.size, known.mtime):
+                num_unchanged += 1
+                continue
+        tasks.append((hocr_path, known and known.hash))
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = _imap_bounded(pool, _extract_rows, tasks, jobs * 2)
+    else:
+        results = (_extract_rows(t) for t in tasks)
+    num_failed = 0
+    try:
+        with click.progressbar(results, length=len(tasks),
+                               item_show_func=show_fn) as results:
+            for hocr_path, fingerprint, rows, error in results:
+                if error is not None:
+                    num_failed += 1
+                    logger.error("Could not ingest {}".format(hocr_path))
+                    logger.error(error)
+                    continue
+                try:
+                    if rows is None:
+                        # Touched or moved, but the content is the same
+                        num_unchanged += 1
+                        repository.update_fingerprint(
+                            get_doc_id(hocr_path), str(hocr_path),
+                            fingerprint)
+                    else:
+                        repository.store_document(rows,
+                                                  autocomplete_min_count)
+                except Exception as e:
+                    num_failed += 1
+                    logger.error("Could not ingest {}".format(hocr_path))
+                    logger.exception(e)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    click.echo("Indexed {} books, {} were unchanged, {} failed".format(
+        len(hocr_files) - num_unchanged - num_failed, num_unchanged,
+        num_failed))
+
+
+@cli.command('pretile')
+@click.argument('base_directory', required=False,
+                type=click.Path(file_okay=False, exists=True, readable=True))
+@click.option('-b', '--book', 'book_ids', multiple=True,
+              help="Only render the pages of this book, can be repeated")
+@click.option('-j', '--jobs', type=int, default=cpu_count(),
+              help="Number of processes used for rendering")
+@click.pass_context
+def pretile(ctx, base_directory, book_ids, jobs):
+    """ Render the image tiles and thumbnails of all pages ahead of time.
+
+    Pages that were rendered completely before are skipped, so an
+    interrupted run can simply be started again.
+    """
+    import webapp
+    global repository
+    if repository is None:
+        if base_directory is None:
+            raise click.BadArgumentUsage("Please specify a base directory.")
+        repository = FilesystemRepository(
+            pathlib.Path(base_directory),
+            cache=DiskCache(ctx.obj['CACHE_DIR'] / 'documents'))
+    pyramid_dir = ctx.obj['CACHE_DIR'] / 'pyramid'
+    pages = [
+        ('{}:{}'.format(book_id, page_id), img_path, width, height,
+         pyramid_dir)
+        for book_id in (book_ids or repository.document_ids())
+        for page_id, img_path, width, height in (
+            repository.get_pages(book_id) or [])]
+
+    num_rendered = num_skipped = num_failed = 0
+    start_time = time.time()
+    pool = Pool(jobs)
+    try:
+        results = pool.imap_unordered(webapp.render_page, pages)
+        with click.progressbar(results, length=len(pages)) as results:
+            for uuid, rendered, error in results:
+                if error is not None:
+                    num_failed += 1
+                    logger.error("Could not render {}".format(uuid))
+                    logger.error(error)
+                elif rendered is None:
+                    num_skipped += 1
+                else:
+                    num_rendered += rendered
+    finally:
+        pool.terminate()
+    duration = time.time() - start_time
+    num_pages = len(pages) - num_skipped - num_failed
+    click.echo(
+        "Rendered {} images for {} pages in {:.1f}s ({:.1f} pages/s, "
+        "{:.1f} images/s), {} pages were already complete, {} failed"
+        .format(num_rendered, num_pages, duration,
+                num_pages / duration if duration else 0,
+                num_rendered / duration if duration else 0,
+                num_skipped, num_failed))
+
+
+@cli.command('export')
+@click.argument('output_directory', type=click.Path(file_okay=False))
+@click.argument('base_directory', required=False,
+                type=click.Path(file_okay=False, exists=True, readable=True))
+@click.option('--base-url', required=True,
+              help="URL the output directory will be published under")
+@click.option('--search-url',
+              help="URL of a server started with `serve` that the manifests "
+                   "link for searching inside the books")
+@click.option('-b', '--book', 'book_ids', multiple=True,
+              help="Only export this book, can be repeated")
+@click.option('-j', '--jobs', type=int, default=cpu_count(),
+              help="Number of processes used for exporting")
+@click.pass_context
+def export(ctx, output_directory, base_directory, base_url, search_url,
+           book_ids, jobs):
+    """ Write the manifests, annotation lists and image tiles of all books
+    as static files, so they can be served without the application.
+
+    Books that have not changed since they were exported with the same
+    URLs, and pages whose tiles are complete, are skipped.
+    """
+    import webapp
+    global repository
+    if repository is None:
+        if base_directory is None:
+            raise click.BadArgumentUsage("Please specify a base directory.")
+        repository = FilesystemRepository(
+            pathlib.Path(base_directory),
+            cache=DiskCache(ctx.obj['CACHE_DIR'] / 'documents'))
+    webapp.repository = repository
+    output_dir = pathlib.Path(output_directory)
+    image_dir = output_dir / 'iiif' / 'image' / 'v2'
+    base_url = base_url.rstrip('/')
+    if search_url is not None:
+        search_url = search_url.rstrip('/')
+    books = [(book_id, output_dir, base_url, search_url)
+             for book_id in (book_ids or repository.document_ids())]
+
+    num_exported = num_failed = num_rendered = num_pages_failed = 0
+    pages = []
+    start_time = time.time()
+    pool = Pool(jobs)
+    try:
+        for book_id, book_pages, exported, error in pool.imap_unordered(
+                webapp.export_book, books):
+            if error is not None:
+                num_failed += 1
+                logger.error("Could not export {}".format(book_id))
+                logger.error(error)
+                continue
+            num_exported += exported
+            pages.extend(
+                ('{}:{}'.format(book_id, page_id), img_path, width, height,
+                 image_dir, base_url)
+                for page_id, img_path, width, height in book_pages)
+        results = pool.imap_unordered(webapp.export_page, pages)
+        with click.progressbar(results, length=len(pages)) as results:
+            for uuid, rendered, error in results:
+                if error is not None:
+                    num_pages_failed += 1
+                    logger.error("Could not render {}".format(uuid))
+                    logger.error(error)
+                elif rendered is not None:
+                    num_rendered += rendered
+    finally:
+        pool.terminate()
+    click.echo(
+        "Exported {} books and rendered {} images in {:.1f}s, {} books were "
+        "unchanged, {} books and {} pages failed".format(
+            num_exported, num_rendered, time.time() - start_time,
+            len(books) - num_exported - num_failed, num_failed,
+            num_pages_failed))
 
 
 if __name__ == '__main__':
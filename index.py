@@ -1,31 +1,128 @@
-import gzip
+import hashlib
 import json
 import logging
+import os
+import pathlib
 import re
 import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
 from collections import Counter, namedtuple, OrderedDict
-from contextlib import contextmanager
-from functools import lru_cache
-from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from itertools import count, groupby
+from operator import itemgetter
 
 import lxml.etree
-from PIL import Image
 
-LineInfo = namedtuple('LineInfo', ('y_pos', 'height', 'sequence_pos'))
-WordInfo = namedtuple('WordInfo', ('sequence_pos', 'start_x', 'end_x'))
+import metrics
+from cache import MemoryCache
+
+HocrPage = namedtuple('HocrPage',
+                      ('id', 'dimensions', 'img_path', 'img_md5', 'lines'))
+DocumentRows = namedtuple('DocumentRows', ('document', 'pages', 'lines'))
+FileFingerprint = namedtuple('FileFingerprint', ('size', 'mtime', 'hash'))
 
-LineInfo = namedtuple('LineInfo', ('y_pos', 'height', 'sequence_pos'))
-WordInfo = namedtuple('WordInfo', ('sequence_pos', 'start_x', 'end_x'))
 
 logger = logging.getLogger(__name__)
 
-SCHEMA = """
+FTS_TOKENIZE = "porter unicode61 remove_diacritics 1"
+#: Incremented whenever the schema changes, databases with an older version
+#: are brought up to date with :py:meth:`DatabaseRepository.migrate`
+SCHEMA_VERSION = 9
+#: The search index rows of a document get rowids from a contiguous range
+#: starting at `documents.id << PAGE_ROWID_BITS`, so FTS5 can restrict a
+#: search to a single document without visiting matches in other documents
+PAGE_ROWID_BITS = 20
+#: Header of documents compiled with :py:func:`compile_document`: magic
+#: number, modification time and size of the hOCR file, length of the page
+#: table and number of lines
+COMPILED_HEADER = struct.Struct('<4sqqII4x')
+COMPILED_MAGIC = b'HVD1'
+MISSING_COORD = -0x80000000
+#: Default budget for the parsed documents held in memory per process
+DOCUMENT_CACHE_SIZE = 256 * 1024 * 1024
+#: Default budget for the search results held in memory per process
+SEARCH_CACHE_SIZE = 32 * 1024 * 1024
+#: Estimated memory used by a cached search result besides its text and
+#: word boxes
+SEARCH_RESULT_OVERHEAD = 256
+#: Estimated memory used per page by the page table of a compiled document
+PAGE_TABLE_ENTRY_SIZE = 512
+#: Number of page images that are read at the same time to determine
+#: their dimensions
+PROBE_WORKERS = 8
+#: Bytes read at a time when hashing hOCR files
+HASH_CHUNK_SIZE = 1024 * 1024
+#: Seconds before the filesystem catalog checks for new or removed documents
+CATALOG_RESCAN_INTERVAL = 60
+#: Number of terms precomputed for every prefix of up to
+#: `AUTOCOMPLETE_PREFIX_DEPTH` characters, longer prefixes are looked up via
+#: a range scan over the sorted terms
+AUTOCOMPLETE_TOP_K = 25
+AUTOCOMPLETE_PREFIX_DEPTH = 3
+
+#: Indexes for looking up the pages and lines of a single document
+DOCUMENT_INDEXES = (
+    """
+    CREATE INDEX IF NOT EXISTS pages_document_idx
+        ON pages (document_id, page_id);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS transcriptions_document_idx
+        ON transcriptions (document_id, page_id, position);
+    """)
+#: Lookup of image dimensions that were read from the image file, by the
+#: path and modification time of the image
+IMAGE_SIZE_INDEX = """
+    CREATE INDEX IF NOT EXISTS pages_img_path_idx
+        ON pages (img_path, img_mtime) WHERE img_mtime IS NOT NULL;
+"""
+TEXT_INDEX_SCHEMA = """
+    CREATE VIRTUAL TABLE {name} USING fts5 (
+        text,
+        word_infos  UNINDEXED,
+        page_id     UNINDEXED,
+        document_id UNINDEXED,
+        {content}
+        prefix='2 3',
+        tokenize='{tokenize}'
+    );
+"""
+#: The search index only holds the inverted index, the text is read from
+#: `page_texts` for highlighting
+TEXT_INDEX_CONTENT = "content='page_texts', content_rowid='id',"
+AUTOCOMPLETE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS autocomplete_terms (
+        document_id TEXT,
+        term        TEXT,
+        cnt         INTEGER,
+        PRIMARY KEY (document_id, term)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS autocomplete_top (
+        document_id TEXT,
+        prefix      TEXT,
+        rank        INTEGER,
+        term        TEXT,
+        cnt         INTEGER,
+        PRIMARY KEY (document_id, prefix, rank)
+    ) WITHOUT ROWID;
+    """)
+#: The text of a line is only stored as part of the text of its page in
+#: `page_texts`, lines refer to it by character offset
+TRANSCRIPTIONS_SCHEMA = """
     CREATE TABLE IF NOT EXISTS transcriptions (
         id          INTEGER PRIMARY KEY,
         page_id     TEXT,
         document_id TEXT,
-        text        TEXT,
-        word_cuts   TEXT,
+        text_offset INTEGER,
+        text_length INTEGER,
         position    INTEGER,
         pos_x       INTEGER,
         pos_y       INTEGER,
@@ -33,7 +130,19 @@ SCHEMA = """
         height      INTEGER,
         UNIQUE(page_id, document_id, position) ON CONFLICT REPLACE
     );
-
+"""
+#: Content table of the search index
+PAGE_TEXTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS page_texts (
+        id          INTEGER PRIMARY KEY,
+        document_id TEXT,
+        page_id     TEXT,
+        text        TEXT,
+        word_infos  BLOB,
+        UNIQUE(document_id, page_id)
+    );
+"""
+SCHEMA = TRANSCRIPTIONS_SCHEMA + PAGE_TEXTS_SCHEMA + """
     CREATE TABLE IF NOT EXISTS pages (
         id          INTEGER PRIMARY KEY,
         page_id     TEXT,
@@ -42,6 +151,7 @@ SCHEMA = """
         img_width   INTEGER,
         img_height  INTEGER,
         img_md5     INTEGER,
+        img_mtime   INTEGER,
         UNIQUE(page_id, document_id) ON CONFLICT REPLACE
     );
 
@@ -49,61 +159,148 @@ SCHEMA = """
         id          INTEGER PRIMARY KEY,
         document_id TEXT UNIQUE,
         filename    TEXT UNIQUE,
-        metadata    TEXT
+        metadata    TEXT,
+        ingested_at REAL,
+        file_size   INTEGER,
+        file_mtime  INTEGER,
+        file_hash   TEXT
     );
-
-    CREATE TABLE IF NOT EXISTS lexica (
-        id          INTEGER PRIMARY KEY,
-        document_id TEXT UNIQUE,
-        counter     BLOB
-    );
-
-    CREATE VIRTUAL TABLE text_idx USING fts5 (
+""" + TEXT_INDEX_SCHEMA.format(name='text_idx', content=TEXT_INDEX_CONTENT,
+                               tokenize=FTS_TOKENIZE) + ''.join(DOCUMENT_INDEXES + (IMAGE_SIZE_INDEX,) + AUTOCOMPLETE_SCHEMA)
+#: Scratch table to count the terms of a single document with exactly the
+#: same normalisation as the search index
+LEXICON_SCHEMA = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS temp.lexicon_idx USING fts5 (
         text,
-        word_infos  UNINDEXED,
-        page_id     UNINDEXED,
-        document_id UNINDEXED,
-        prefix='2 3',
-        tokenize='porter unicode61 remove_diacritics 1'
+        tokenize='{tokenize}'
     );
-    CREATE VIRTUAL TABLE text_vocab USING fts5vocab(text_idx, col);
+    """.format(tokenize=FTS_TOKENIZE),
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS temp.lexicon_vocab
+        USING fts5vocab(temp, lexicon_idx, row);
+    """)
+#: Applied to every connection, readers fall back to the existing journal
+#: mode if they can't switch the database to WAL (e.g. on read-only media)
+JOURNAL_PRAGMA = "PRAGMA journal_mode = WAL;"
+READER_PRAGMAS = """
+    PRAGMA mmap_size = 268435456;
+    PRAGMA cache_size = -16384;
+    PRAGMA query_only = 1;
 """
+WRITER_PRAGMAS = """
+    PRAGMA synchronous = NORMAL;
+    PRAGMA cache_size = -262144;
+    PRAGMA temp_store = MEMORY;
+"""
+#: Number of prepared statements kept around per connection
+STATEMENT_CACHE_SIZE = 256
+
 INSERT_DOCUMENT = """
-    INSERT INTO documents (document_id, filename, metadata)
-        VALUES (:document_id, :filename, :metadata);
+    INSERT INTO documents (document_id, filename, metadata, ingested_at,
+                           file_size, file_mtime, file_hash)
+        VALUES (:document_id, :filename, :metadata, :ingested_at,
+                :file_size, :file_mtime, :file_hash);
 """
+#: Remove the pages of a document from the search index, this has to be done
+#: with the old texts before they are removed from `page_texts`
+DELETE_INDEX_PAGES = """
+    INSERT INTO text_idx (text_idx, rowid, text)
+        SELECT 'delete', id, text FROM page_texts WHERE document_id = ?;
+"""
+#: Tables with rows for a document, by their `document_id` column
+DOCUMENT_TABLES = ('page_texts', 'transcriptions', 'pages',
+                   'autocomplete_terms', 'autocomplete_top', 'documents')
 INSERT_PAGE = """
     INSERT INTO pages (page_id, document_id, img_path, img_width, img_height,
-                       img_md5)
+                       img_md5, img_mtime)
         VALUES (:page_id, :document_id, :img_path, :img_width, :img_height,
-                :img_md5);
+                :img_md5, :img_mtime);
 """
 INSERT_TRANSCRIPTION = """
-    INSERT INTO transcriptions (page_id, document_id, text, position,
-                                word_cuts, pos_x, pos_y, width, height)
-        VALUES (:page_id, :document_id, :text, :position, :word_cuts,
-                :pos_x, :pos_y, :width, :height);
+    INSERT INTO transcriptions (page_id, document_id, text_offset,
+                                text_length, position, pos_x, pos_y, width,
+                                height)
+        VALUES (:page_id, :document_id, :text_offset, :text_length,
+                :position, :pos_x, :pos_y, :width, :height);
 """
+# No `ORDER BY rank`: bm25 weighs terms by how many rows in the whole index
+# contain them, which has to be counted on every query and makes the search
+# as slow as the corpus is large. Matches are ranked in Python instead.
 SEARCH_INSIDE = """
-    SELECT page_id, highlight(text_idx, 0, '<hi>', '</hi>'),
-           word_infos, rank AS score FROM text_idx
-        WHERE text_idx MATCH :query AND document_id = :document_id
-        ORDER BY score
+    SELECT page_id, highlight(text_idx, 0, '<hi>', '</hi>'), word_infos
+        FROM text_idx
+        WHERE text_idx MATCH :query
+              AND rowid >= :first_rowid AND rowid <= :last_rowid;
+"""
+#: Ranks the matching pages of all documents by bm25, then by rowid so that
+#: the order is total and can be resumed from any page. Only the doclists
+#: and page lengths are read, not the page texts.
+SEARCH_CORPUS = """
+    SELECT rank, rowid FROM text_idx
+        WHERE text_idx MATCH :query {condition}
+        ORDER BY rank {order}, rowid {order}
         LIMIT :limit;
 """
-UPDATE_INDEX_SINGLE_DOCUMENT = """
-    INSERT INTO text_idx (document_id, page_id, text, word_infos)
-        SELECT document_id, page_id,
-               group_concat(text, ' ') AS text,
-               group_concat(word_infos, ' ') AS word_infos
-        FROM (SELECT
-                document_id, page_id, text,
-                (word_cuts || '|' || pos_y ||
-                 ':' || height || ':' || position || '||') AS word_infos
-              FROM transcriptions
+#: Highlighted texts and word boxes of a page of corpus search results
+SEARCH_CORPUS_PAGES = """
+    SELECT rowid, document_id, page_id,
+           highlight(text_idx, 0, '<hi>', '</hi>'), word_infos
+        FROM text_idx
+        WHERE text_idx MATCH ? AND rowid IN ({placeholders});
+"""
+INSERT_PAGE_TEXT = """
+    INSERT INTO page_texts (id, document_id, page_id, text, word_infos)
+        VALUES (:rowid, :document_id, :page_id, :text, :word_infos);
+"""
+INSERT_INDEX_PAGE = """
+    INSERT INTO text_idx (rowid, text) VALUES (:rowid, :text);
+"""
+INSERT_AUTOCOMPLETE_TERM = """
+    INSERT INTO autocomplete_terms (document_id, term, cnt)
+        VALUES (?, ?, ?);
+"""
+INSERT_AUTOCOMPLETE_TOP = """
+    INSERT INTO autocomplete_top (document_id, prefix, rank, term, cnt)
+        VALUES (?, ?, ?, ?, ?);
+"""
+GET_LINES_RANGE = """
+    SELECT p.page_id, substr(pt.text, t.text_offset + 1, t.text_length),
+           t.pos_x, t.pos_y, t.width, t.height
+        FROM (SELECT document_id, page_id FROM pages
               WHERE document_id = :document_id
-              ORDER BY page_id, position)
-        GROUP BY page_id;
+                    AND page_id >= :start AND page_id <= :end
+              ORDER BY page_id
+              LIMIT :limit) AS p
+        LEFT JOIN page_texts AS pt
+            ON pt.document_id = p.document_id AND pt.page_id = p.page_id
+        LEFT JOIN transcriptions AS t
+            ON t.document_id = p.document_id AND t.page_id = p.page_id
+        ORDER BY p.page_id, t.position;
+"""
+GET_LINES = """
+    SELECT substr(pt.text, t.text_offset + 1, t.text_length),
+           t.pos_x, t.pos_y, t.width, t.height
+        FROM transcriptions AS t
+        JOIN page_texts AS pt
+            ON pt.document_id = t.document_id AND pt.page_id = t.page_id
+        WHERE t.document_id = :document_id AND t.page_id = :page_id
+        ORDER BY t.position;
+"""
+AUTOCOMPLETE_TOP = """
+    SELECT term, cnt FROM autocomplete_top
+        WHERE document_id = :document_id AND prefix = :prefix
+              AND cnt >= :min_cnt
+        ORDER BY rank
+        LIMIT :limit;
+"""
+AUTOCOMPLETE_RANGE = """
+    SELECT term, cnt FROM autocomplete_terms
+        WHERE document_id = :document_id
+              AND term >= :prefix AND term < :prefix_end
+              AND cnt >= :min_cnt
+        ORDER BY cnt DESC, term
+        LIMIT :limit;
 """
 
 
@@ -112,25 +309,11 @@ class HocrDocument(object):
         self.logger = logger.getChild('HocrDocument')
         self.id = book_id
         self.hocr_path = hocr_path
-        parser = lxml.etree.XMLParser(ns_clean=True, recover=True)
-        self.tree = lxml.etree.parse(str(self.hocr_path), parser)
-        is_xhtml = len(self.tree.getroot().nsmap) > 0
-        self.xpaths = {
-            'page': ".//xhtml:div[@class='ocr_page']",
-            'line': ".//xhtml:span[@class='ocr_line']",
-            'word': ".//xhtml:span[@class='ocr_cinfo']"}
-        if is_xhtml:
-            self.nsmap = {'xhtml': 'http://www.w3.org/1999/xhtml'}
-        else:
-            self.xpaths = {k: xp.replace('xhtml:', '')
-                           for k, xp in self.xpaths.items()}
-            self.nsmap = None
 
     def _parse_title(self, title):
         if title is None:
             return {}
-        return {itm.split(" ")[0]: " ".join(itm.split(" ")[1:])
-                for itm in title.split("; ")}
+        return dict(itm.partition(" ")[::2] for itm in title.split("; "))
 
     def _get_img_path(self, idx, title_data):
         if 'image' in title_data:
@@ -142,66 +325,118 @@ class HocrDocument(object):
         except OSError:
             raise ValueError("Could not determine image path")
 
-    def get_pages(self):
-        page_node_iter = self.tree.iterfind(self.xpaths['page'],
-                                            namespaces=self.nsmap)
-        for idx, page_node in enumerate(page_node_iter):
-            title_data = self._parse_title(page_node.attrib.get('title'))
-            try:
-                img_path = self._get_img_path(idx, title_data)
-            except ValueError:
-                self.logger.debug(
-                    "Could not find page image for page with id={} on book {}"
-                    .format(page_node.attrib.get('id', idx), self.hocr_path))
+    def _parse_page(self, idx, page_node, lines, probe_sizes=True):
+        page_id = page_node.get('id', 'page_{:04}'.format(idx))
+        title_data = self._parse_title(page_node.get('title'))
+        try:
+            img_path = self._get_img_path(idx, title_data)
+        except ValueError:
+            self.logger.debug(
+                "Could not find page image for page with id={} on book {}"
+                .format(page_node.get('id', idx), self.hocr_path))
+            return HocrPage(page_id, None, None, None, lines)
+        if 'bbox' not in title_data:
+            dimensions = probe_image_size(img_path) if probe_sizes else None
+        else:
+            dimensions = [int(x) for x in title_data['bbox'].split()[2:]]
+        return HocrPage(page_id, dimensions, img_path,
+                        title_data.get('imagemd5'), lines)
+
+    def _parse_line(self, line_node, page_node, word_idx_gen):
+        title_data = self._parse_title(line_node.get('title'))
+        if 'bbox' not in title_data:
+            self.logger.debug(
+                "Could not determine bbox for line with id={} "
+                "on page with id={} on book {}"
+                .format(line_node.get('id'), page_node.get('id'),
+                        self.hocr_path))
+            bbox = (None, None, None, None)
+        else:
+            bbox = [int(v) for v in title_data['bbox'].split()]
+        word_cuts = []
+        for word_node in line_node.iter('{*}span'):
+            if word_node.get('class') != 'ocr_cinfo':
                 continue
-            if 'bbox' not in title_data:
-                dimensions = Image.open(str(img_path)).size
+            title_data = self._parse_title(word_node.get('title'))
+            if title_data:
+                word_bbox = title_data['bbox'].split()
+                word_cuts.append((str(next(word_idx_gen)), word_bbox[0],
+                                  word_bbox[2]))
             else:
-                dimensions = [
-                    int(x) for x in title_data['bbox'].split()[2:]]
-            page_id = page_node.attrib.get('id', 'page_{:04}'.format(idx))
-            yield page_id, dimensions, img_path, title_data.get('imagemd5')
+                word_cuts.append((str(next(word_idx_gen)), "-1", "-1"))
+        text = re.sub(r'\s{2,}', ' ', "".join(line_node.itertext()).strip())
+        return text, bbox, word_cuts
 
-    def get_lines(self):
-        page_node_iter = self.tree.iterfind(self.xpaths['page'],
-                                            namespaces=self.nsmap)
-        for idx, page_node in enumerate(page_node_iter):
-            page_id = page_node.attrib.get('id', 'page_{:04}'.format(idx))
-            lines = []
-            line_nodes = page_node.iterfind(self.xpaths['line'],
-                                            namespaces=self.nsmap)
-            word_idx_gen = (str(v) for v in count())
-            for line_node in line_nodes:
-                if 'not_aligned' in line_node.attrib.get('class').split():
+    @metrics.timed('hocrviewer_hocr_parse_seconds')
+    def iter_pages(self, probe_sizes=True):
+        """ Parse the document in a single pass.
+
+        Elements are discarded as soon as they have been processed, so the
+        memory needed only depends on the size of the largest page, not on
+        the size of the document.
+
+        :param probe_sizes: Read the dimensions of pages without a `bbox`
+                            from their image, otherwise they are left as
+                            `None` to be filled in with
+                            :py:func:`probe_image_sizes`
+        :returns:   Generator that yields a :py:class:`HocrPage` for every
+                    `ocr_page`, pages without an image have their
+                    `img_path` and `dimensions` set to `None`
+        """
+        page_idx = -1
+        page_node = None
+        lines = word_idx_gen = None
+        line_depth = 0
+        context = lxml.etree.iterparse(str(self.hocr_path),
+                                       events=('start', 'end'), recover=True)
+        for event, node in context:
+            if not isinstance(node.tag, str):
+                continue
+            tag = node.tag.rpartition('}')[2]
+            cls = node.get('class')
+            is_line = (page_node is not None and tag == 'span' and
+                       cls == 'ocr_line')
+            if event == 'start':
+                if page_node is None and tag == 'div' and cls == 'ocr_page':
+                    page_idx += 1
+                    page_node = node
+                    lines = []
+                    word_idx_gen = count()
+                elif is_line:
+                    line_depth += 1
+                continue
+            if is_line:
+                line_depth -= 1
+                if line_depth > 0:
+                    # Nested line, it is parsed along with the outermost
+                    # line so that lines and words are numbered in document
+                    # order
                     continue
-                title_data = self._parse_title(
-                    line_node.attrib.get('title'))
-                if 'bbox' not in title_data:
-                    self.logger.debug(
-                        "Could not determine bbox for line with id={} "
-                        "on page with id={} on book {}"
-                        .format(line_node.attrib.get('id'), page_id,
-                                self.hocr_path))
-                    bbox = (None, None, None, None)
-                else:
-                    bbox = [int(v) for v in title_data['bbox'].split()]
-                word_nodes = line_node.iterfind(
-                    self.xpaths['word'], namespaces=self.nsmap)
-                word_cuts = []
-                for word_node in word_nodes:
-                    title_data = self._parse_title(
-                        word_node.attrib.get('title'))
-                    if title_data:
-                        word_bbox = title_data['bbox'].split()
-                        word_cuts.append((next(word_idx_gen), word_bbox[0],
-                                          word_bbox[2]))
-                    else:
-                        word_cuts.append((next(word_idx_gen), "-1", "-1"))
-                text = re.sub(r'\s{2,}', ' ',
-                              "".join(line_node.itertext()).strip())
-                if text:
-                    lines.append((text, bbox, word_cuts))
-            yield page_id, lines
+                for line_node in node.iter('{*}span'):
+                    if line_node.get('class') != 'ocr_line':
+                        continue
+                    text, bbox, word_cuts = self._parse_line(
+                        line_node, page_node, word_idx_gen)
+                    if text:
+                        lines.append((text, bbox, word_cuts))
+            elif node is page_node:
+                yield self._parse_page(page_idx, page_node, lines,
+                                       probe_sizes)
+                page_node = None
+            elif page_node is not None:
+                continue
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+
+    def get_pages(self):
+        for page in self.iter_pages():
+            if page.img_path is not None:
+                yield page.id, page.dimensions, page.img_path, page.img_md5
+
+    def get_lines(self):
+        for page in self.iter_pages():
+            yield page.id, page.lines
 
 
 def get_doc_id(hocr_path):
@@ -212,114 +447,762 @@ def get_doc_id(hocr_path):
     return doc_id
 
 
+def probe_image_size(img_path):
+    """ Get the dimensions of an image.
+
+    Only the header of the image is read, not the pixel data.
+
+    :returns:   `(width, height)`
+    """
+    # Imported here, most documents have their dimensions in the hOCR
+    from PIL import Image
+    with Image.open(str(img_path)) as img:
+        return img.size
+
+
+def probe_image_sizes(img_paths, max_workers=PROBE_WORKERS):
+    """ Get the dimensions of many images concurrently, see
+    :py:func:`probe_image_size`.
+
+    :param max_workers: Maximum number of images read at the same time
+    :returns:           List of `(width, height)` in the order of the paths
+    """
+    img_paths = list(img_paths)
+    if len(img_paths) <= 1:
+        return [probe_image_size(p) for p in img_paths]
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(probe_image_size, img_paths))
+
+
+def fingerprint_file(path):
+    """ Get the size, modification time and content hash of a file.
+
+    The file is stat'ed before it is read, so if it is modified meanwhile
+    the recorded modification time is outdated and the file is considered
+    changed the next time.
+
+    :type path:     :py:class:`pathlib.Path`
+    :rtype:         :py:class:`FileFingerprint`
+    """
+    stat = path.stat()
+    digest = hashlib.sha1()
+    with path.open('rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return FileFingerprint(stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+
+def extract_document(hocr_path, fingerprint=None):
+    """ Parse a hOCR file into plain rows for the database.
+
+    This does not touch the database, so it can be run in a worker process
+    while a single writer commits the results. Neither does it touch the
+    page images, pages whose dimensions are not in the hOCR have them set
+    to `None`, they are filled in by
+    :py:meth:`DatabaseRepository.store_document`.
+
+    :param hocr_path:   path to load document from
+    :type hocr_path:    :py:class:`pathlib.Path`
+    :param fingerprint: fingerprint of the file if it was already taken
+    :type fingerprint:  :py:class:`FileFingerprint`
+    :returns:           Rows for the document, its pages and lines
+    :rtype:             :py:class:`DocumentRows`
+    """
+    if fingerprint is None:
+        fingerprint = fingerprint_file(hocr_path)
+    doc_id = get_doc_id(hocr_path)
+    doc = HocrDocument(doc_id, hocr_path)
+    pages = []
+    lines = []
+    for page in doc.iter_pages(probe_sizes=False):
+        if page.img_path is not None:
+            pages.append(dict(
+                page_id=page.id, document_id=doc_id,
+                img_path=str(page.img_path),
+                img_width=page.dimensions and page.dimensions[0],
+                img_height=page.dimensions and page.dimensions[1],
+                img_mtime=None, img_md5=page.img_md5))
+        lines.extend(
+            dict(document_id=doc_id, page_id=page.id,
+                 text=line_text, position=pos,
+                 word_cuts=" ".join(':'.join(c) for c in word_cuts),
+                 pos_x=x1, pos_y=y1,
+                 width=x2-x1 if x1 and x2 else None,
+                 height=y2-y1 if x1 and x2 else None)
+            for pos, (line_text, (x1, y1, x2, y2), word_cuts)
+            in enumerate(page.lines))
+    return DocumentRows(
+        document=dict(document_id=doc_id, filename=str(hocr_path),
+                      metadata=None, file_size=fingerprint.size,
+                      file_mtime=fingerprint.mtime,
+                      file_hash=fingerprint.hash),
+        pages=pages, lines=lines)
+
+
+def pack_word_boxes(lines):
+    """ Pack the word coordinates of a page into a compact binary format.
+
+    The result starts with a four byte header whose first byte is the
+    :py:mod:`array` typecode of the values that follow: unsigned 16 bit
+    integers if all values fit, otherwise signed 32 bit integers, both
+    little-endian. The values are the number of lines and words, followed
+    by `(y, height)` for every line and `(start_x, end_x, line_index)` for
+    every word, indexed by the word's sequence position on the page.
+    Missing values are stored as the largest value of the type (for 16 bit)
+    or -1.
+
+    :param lines:   `(word_cuts, y_pos, height)` for every line of the page,
+                    where `word_cuts` is the space-separated
+                    `seq:start_x:end_x` string from :py:func:`extract_document`
+    :rtype:         bytes
+    """
+    line_boxes = []
+    word_boxes = []
+    for word_cuts, y_pos, height in lines:
+        if y_pos is None or height is None:
+            continue
+        line_idx = len(line_boxes) // 2
+        line_boxes.extend((y_pos, height))
+        for cut in word_cuts.split():
+            seq, start_x, end_x = (int(v) if v != '' else -1
+                                   for v in cut.split(':'))
+            end = 3 * (seq + 1)
+            if len(word_boxes) < end:
+                word_boxes.extend([-1] * (end - len(word_boxes)))
+            word_boxes[end - 3:end] = (start_x, end_x, line_idx)
+    values = [len(line_boxes) // 2, len(word_boxes) // 3]
+    values.extend(line_boxes)
+    values.extend(word_boxes)
+    if all(-1 <= v < 0xFFFF for v in values):
+        packed = array('H', (0xFFFF if v == -1 else v for v in values))
+    else:
+        packed = array('i', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.typecode.encode('ascii').ljust(4, b'\0') + packed.tobytes()
+
+
+class WordBoxes(object):
+    def __init__(self, packed):
+        """ Read-only view on word coordinates packed with
+        :py:func:`pack_word_boxes`.
+
+        On little-endian machines the data is not copied, only the words
+        that are actually looked up are decoded.
+        """
+        typecode = chr(packed[0])
+        if sys.byteorder == 'big':
+            data = array(typecode)
+            data.frombytes(packed[4:])
+            data.byteswap()
+            data = memoryview(data)
+        else:
+            data = memoryview(packed)[4:].cast(typecode)
+        self._missing = 0xFFFF if typecode == 'H' else -1
+        num_lines = data[0]
+        self._lines = data[2:2 + 2 * num_lines]
+        self._words = data[2 + 2 * num_lines:]
+
+    def __len__(self):
+        return len(self._words) // 3
+
+    def get(self, seq):
+        """ Get the bounding box of the word at sequence position `seq`.
+
+        :returns:   `(x, y, width, height)` or `None` if the position of the
+                    word is not known, missing horizontal coordinates are
+                    returned as -1
+        """
+        if not 0 <= seq < len(self):
+            return None
+        start_x, end_x, line_idx = self._words[3 * seq:3 * seq + 3]
+        if line_idx == self._missing:
+            return None
+        if start_x == self._missing:
+            start_x = -1
+        if end_x == self._missing:
+            end_x = -1
+        return (start_x, self._lines[2 * line_idx], end_x - start_x,
+                self._lines[2 * line_idx + 1])
+
+
+def compile_document(document_id, hocr_path, mtime_ns, size):
+    """ Parse a hOCR file into the binary format read by
+    :py:class:`CompiledDocument`.
+
+    The result starts with a header (see `COMPILED_HEADER`) that records
+    the modification time and size of the hOCR file it was compiled from.
+    It is followed by a JSON table of the pages with their dimensions,
+    image paths and the range of their lines, padded to four bytes. Then
+    come six little-endian signed 32 bit integers for every line, its
+    `(x, y, width, height)` and the offset and length of its text, and
+    finally the UTF-8 encoded text of all lines. Missing coordinates are
+    stored as `MISSING_COORD`.
+
+    :param mtime_ns:    Modification time of the file in nanoseconds
+    :param size:        Size of the file in bytes
+    :rtype:             bytes
+    """
+    table = []
+    line_values = array('i')
+    texts = []
+    text_offset = 0
+    num_lines = 0
+    unprobed = []
+    for page in HocrDocument(document_id, hocr_path).iter_pages(
+            probe_sizes=False):
+        if page.img_path is None:
+            continue
+        if page.dimensions is None:
+            unprobed.append(len(table))
+        width, height = page.dimensions or (None, None)
+        table.append([page.id, width, height, str(page.img_path), num_lines,
+                      len(page.lines)])
+        for text, (x1, y1, x2, y2), _ in page.lines:
+            if x1 is None:
+                line_values.extend((MISSING_COORD,) * 4)
+            else:
+                line_values.extend((x1, y1, x2 - x1, y2 - y1))
+            encoded = text.encode('utf8')
+            line_values.extend((text_offset, len(encoded)))
+            texts.append(encoded)
+            text_offset += len(encoded)
+        num_lines += len(page.lines)
+    probed = probe_image_sizes(table[idx][3] for idx in unprobed)
+    for idx, dimensions in zip(unprobed, probed):
+        table[idx][1:3] = dimensions
+    if sys.byteorder == 'big':
+        line_values.byteswap()
+    table = json.dumps(table).encode('utf8')
+    parts = [COMPILED_HEADER.pack(COMPILED_MAGIC, mtime_ns, size, len(table),
+                                  num_lines),
+             table, b' ' * (-len(table) % 4), line_values.tobytes()]
+    parts.extend(texts)
+    return b''.join(parts)
+
+
+class CompiledDocument(object):
+    def __init__(self, data):
+        """ Read-only view on a document compiled with
+        :py:func:`compile_document`.
+
+        `data` can be a memory-mapped file, in which case the lines of a
+        page are only read from it when they are requested.
+
+        :raises ValueError: If `data` is not a compiled document
+        """
+        magic, mtime_ns, size, table_len, num_lines = \
+            COMPILED_HEADER.unpack_from(data)
+        if magic != COMPILED_MAGIC:
+            raise ValueError("Not a compiled document")
+        self.mtime_ns = mtime_ns
+        self.size = size
+        #: Monotonic time the hOCR file was last checked for changes
+        self.checked_at = None
+        view = memoryview(data)
+        offset = COMPILED_HEADER.size
+        self.pages = OrderedDict(
+            (page_id, (page_id, pathlib.Path(img_path), width, height,
+                       first_line, num_page_lines))
+            for page_id, width, height, img_path, first_line, num_page_lines
+            in json.loads(bytes(view[offset:offset + table_len])
+                          .decode('utf8')))
+        #: Estimated memory used by the document, memory-mapped data is
+        #: counted in full even though it can be shared between processes
+        self.nbytes = view.nbytes + PAGE_TABLE_ENTRY_SIZE * len(self.pages)
+        offset += table_len + (-table_len % 4)
+        lines_end = offset + 24 * num_lines
+        if sys.byteorder == 'big':
+            lines = array('i')
+            lines.frombytes(view[offset:lines_end])
+            lines.byteswap()
+            self._lines = memoryview(lines)
+        else:
+            self._lines = view[offset:lines_end].cast('i')
+        self._text = view[lines_end:]
+
+    def get_page(self, page_id):
+        """ :returns:   `(page_id, img_path, width, height)` or `None` """
+        page = self.pages.get(page_id)
+        if page is not None:
+            return page[:4]
+
+    def get_lines(self, page_id):
+        """ :returns:   List of `(text, x, y, width, height)` for the lines on
+                        the page or `None` if the page does not exist
+        """
+        page = self.pages.get(page_id)
+        if page is None:
+            return None
+        lines = []
+        first_line, num_lines = page[4:]
+        for idx in range(first_line, first_line + num_lines):
+            x, y, width, height, text_offset, text_len = \
+                self._lines[6 * idx:6 * idx + 6]
+            text = bytes(self._text[text_offset:text_offset + text_len])
+            if x == MISSING_COORD:
+                x = y = width = height = None
+            lines.append((text.decode('utf8'), x, y, width, height))
+        return lines
+
+
+def _page_rowid(doc_rowid, page_num):
+    """ Get the rowid of a page in the search index.
+
+    :param doc_rowid:   Rowid of the document in the `documents` table
+    :param page_num:    Ordinal of the page in the document
+    """
+    if page_num >= (1 << PAGE_ROWID_BITS):
+        raise ValueError(
+            "Documents can have at most {} pages in the search index"
+            .format(1 << PAGE_ROWID_BITS))
+    return (doc_rowid << PAGE_ROWID_BITS) + page_num
+
+
+def _join_lines(texts):
+    """ Join the texts of the lines on a page.
+
+    :returns:   The page text and the `(offset, length)` of every line in it
+    """
+    offsets = []
+    offset = 0
+    for text in texts:
+        offsets.append((offset, len(text)))
+        offset += len(text) + 1
+    return ' '.join(texts), offsets
+
+
+def _prefix_end(prefix):
+    """ Smallest string that sorts after all strings starting with `prefix`.
+    """
+    if not prefix:
+        return chr(sys.maxunicode)
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class DocumentCatalog(object):
+    def __init__(self, base_directory,
+                 rescan_interval=CATALOG_RESCAN_INTERVAL):
+        """ Mapping of document ids to the paths of their hOCR files.
+
+        The directory tree is listed once and then rescanned at most every
+        `rescan_interval` seconds. A rescan only stats the known
+        directories and lists those whose modification time changed, i.e.
+        that had entries added, removed or renamed. Only one thread
+        rescans at a time, the others keep using the previous catalog
+        meanwhile.
+
+        :param base_directory:  Directory to search for hOCR files
+        :type base_directory:   :py:class:`pathlib.Path`
+        :param rescan_interval: Minimum number of seconds between rescans
+        """
+        self._base_dir = base_directory
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        #: Directory path -> (mtime, hOCR file names, subdirectory names)
+        self._directories = {}
+        self._paths = {}
+        self._ids = []
+        self._scanned_at = None
+
+    def refresh(self, force=False):
+        """ Rescan the directory tree if the rescan interval has passed.
+
+        :param force:   Rescan regardless of the interval, waits for a
+                        rescan by another thread to finish
+        """
+        if not force and not self._is_due():
+            return
+        # Threads only wait for the first scan, there is no catalog before
+        if not self._lock.acquire(force or self._scanned_at is None):
+            return
+        try:
+            if not force and not self._is_due():
+                # Rescanned by another thread meanwhile
+                return
+            now = time.monotonic()
+            directories = {}
+            changed = self._scan(str(self._base_dir), directories)
+            changed = changed or directories.keys() != self._directories.keys()
+            self._directories = directories
+            if changed:
+                self._update_paths()
+            self._scanned_at = now
+        finally:
+            self._lock.release()
+
+    def _is_due(self):
+        return (self._scanned_at is None or
+                time.monotonic() - self._scanned_at >= self.rescan_interval)
+
+    def _scan(self, dir_path, directories):
+        try:
+            mtime = os.stat(dir_path).st_mtime
+        except OSError:
+            return True
+        known = self._directories.get(dir_path)
+        changed = known is None or known[0] != mtime
+        if changed:
+            files, subdirs = [], []
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        # Like `glob('**')`, symlinks to directories are not
+                        # followed, they could form a loop
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.name.endswith('.html'):
+                            files.append(entry.name)
+            except OSError:
+                return True
+            known = (mtime, files, subdirs)
+        directories[dir_path] = known
+        for name in known[2]:
+            changed = self._scan(os.path.join(dir_path, name),
+                                 directories) or changed
+        return changed
+
+    def _update_paths(self):
+        paths = {}
+        # Sorting by depth makes `<id>.html` win over `<id>/hOCR.html`
+        for dir_path in sorted(self._directories,
+                               key=lambda p: (p.count(os.sep), p)):
+            for name in sorted(self._directories[dir_path][1]):
+                path = pathlib.Path(dir_path, name)
+                paths.setdefault(get_doc_id(path), path)
+        self._paths = paths
+        self._ids = sorted(paths)
+
+    def get_path(self, document_id):
+        self.refresh()
+        return self._paths.get(document_id)
+
+    def document_ids(self, offset=0, limit=None):
+        """ Get the document ids in sorted order.
+
+        :param offset:  Number of ids to skip
+        :param limit:   Maximum number of ids to return
+        """
+        self.refresh()
+        end = None if limit is None else offset + limit
+        return self._ids[offset:end]
+
+    def __len__(self):
+        self.refresh()
+        return len(self._ids)
+
+
 class FilesystemRepository(object):
-    def __init__(self, base_directory):
+    def __init__(self, base_directory,
+                 rescan_interval=CATALOG_RESCAN_INTERVAL, cache=None,
+                 document_cache_size=DOCUMENT_CACHE_SIZE):
+        """ Documents read directly from hOCR files.
+
+        :param base_directory:  Directory to search for hOCR files
+        :type base_directory:   :py:class:`pathlib.Path`
+        :param rescan_interval: Minimum number of seconds between checks
+                                for new or removed files, and for changes
+                                of a document that is in memory
+        :param cache:           Cache for compiled documents, documents are
+                                parsed again by every process without it
+        :type cache:            :py:class:`cache.DiskCache`
+        :param document_cache_size: Budget in bytes for the documents kept
+                                    in memory
+        """
         self._base_dir = base_directory
+        self._catalog = DocumentCatalog(base_directory, rescan_interval)
+        self._cache = cache
+        self._documents = MemoryCache(document_cache_size)
+
+    def document_ids(self, offset=0, limit=None):
+        return self._catalog.document_ids(offset, limit)
+
+    def document_count(self):
+        return len(self._catalog)
 
-    def document_ids(self):
-        return [get_doc_id(p) for p in self._base_dir.glob("**/*.html")]
+    def preload(self):
+        """ Scan the base directory right away instead of on the first
+        request.
+
+        When called before the server forks its workers, they all start
+        out with the catalog of the parent process and share its memory
+        until they rescan.
+        """
+        self._catalog.refresh(force=True)
 
-    @lru_cache()
     def _read_document(self, document_id):
         doc_path = self._get_doc_path(document_id)
         if doc_path is None:
             return None
-        doc = HocrDocument(document_id, doc_path)
-        lines = OrderedDict()
-        for pid, ls in doc.get_lines():
-            lines[pid] = [(text, x1, y1, x2-x1, y2-y1)
-                          for text, (x1, y1, x2, y2), _ in ls]
-        return {
-            'id': doc.id,
-            'hocr_path': doc.hocr_path,
-            'pages': OrderedDict([
-                (pid, {'id': pid,
-                       'dimensions': dimensions,
-                       'img_path': img_path,
-                       'img_md5': img_md5,
-                       'lines': lines[pid]})
-                for pid, dimensions, img_path, img_md5 in doc.get_pages()])}
-
-    def _get_doc_path(self, doc_id):
-        fpath = self._base_dir / (doc_id + ".html")
-        if not fpath.exists():
-            fpath = self._base_dir / doc_id / "hOCR.html"
-        if not fpath.exists():
+        key = str(doc_path)
+        doc = self._documents.get(key)
+        now = time.monotonic()
+        if (doc is not None and
+                now - doc.checked_at < self._catalog.rescan_interval):
+            return doc
+        try:
+            stat = doc_path.stat()
+        except OSError:
             return None
+        if doc is None or (doc.mtime_ns, doc.size) != (stat.st_mtime_ns,
+                                                       stat.st_size):
+            doc = self._load_document(document_id, doc_path,
+                                      stat.st_mtime_ns, stat.st_size)
+            doc.checked_at = now
+            self._documents.set(key, doc, doc.nbytes)
         else:
-            return fpath
+            doc.checked_at = now
+        return doc
+
+    def _load_document(self, document_id, doc_path, mtime_ns, size):
+        """ Get the compiled version of a hOCR file, from the disk cache if
+        it was compiled before, otherwise the file is parsed and the result
+        stored in the disk cache.
+
+        Cached documents are memory-mapped, so all processes serving a
+        document share a single copy of it in the OS page cache.
+        """
+        key = str(doc_path)
+        if self._cache is not None:
+            data = self._cache.map(key)
+            if data is not None:
+                try:
+                    doc = CompiledDocument(data)
+                except ValueError:
+                    doc = None
+                if doc is not None and (doc.mtime_ns, doc.size) == (mtime_ns,
+                                                                    size):
+                    return doc
+        data = compile_document(document_id, doc_path, mtime_ns, size)
+        if self._cache is not None:
+            self._cache.set(key, data)
+            data = self._cache.map(key) or data
+        return CompiledDocument(data)
+
+    def cache_stats(self):
+        """ Get the counters of the in-memory caches, see
+        :py:meth:`cache.MemoryCache.stats`.
+
+        :returns:   Mapping of cache names to their counters
+        """
+        return {'documents': self._documents.stats()}
+
+    def _get_doc_path(self, doc_id):
+        return self._catalog.get_path(doc_id)
 
     def get_document(self, document_id):
         fpath = self._get_doc_path(document_id)
         if fpath:
             return (document_id, str(fpath), None)
 
+    def get_document_version(self, document_id):
+        """ Get a timestamp that changes whenever the document changes.
+
+        The document is checked for changes as often as when its pages
+        are read, so the version always belongs to the pages that are
+        returned.
+
+        :returns:   Modification time of the hOCR file the document was
+                    read from or `None` if the document does not exist
+        """
+        doc = self._read_document(document_id)
+        if doc is not None:
+            return doc.mtime_ns / 1e9
+
     def get_image_path(self, document_id, page_id):
         doc = self._read_document(document_id)
-        if doc is not None and page_id in doc['pages']:
-            return doc['pages'][page_id]['img_path']
+        if doc is not None and page_id in doc.pages:
+            return doc.pages[page_id][1]
 
     def get_lines(self, document_id, page_id):
         doc = self._read_document(document_id)
-        if doc is not None and page_id in doc['pages']:
-            return doc['pages'][page_id]['lines']
+        if doc is not None:
+            return doc.get_lines(page_id)
+
+    def get_lines_range(self, document_id, start=None, end=None, limit=None):
+        """ Get the lines for a range of pages.
+
+        :param start:   First page id of the range, defaults to the first page
+        :param end:     Last page id of the range, defaults to the last page
+        :param limit:   Maximum number of pages to return
+        :returns:       List of `(page_id, lines)` tuples in page order or
+                        `None` if the document does not exist
+        """
+        doc = self._read_document(document_id)
+        if doc is None:
+            return None
+        out = []
+        in_range = start is None
+        for page_id in doc.pages:
+            in_range = in_range or page_id == start
+            if not in_range:
+                continue
+            if limit is not None and len(out) >= limit:
+                break
+            out.append((page_id, doc.get_lines(page_id)))
+            if page_id == end:
+                break
+        return out
 
     def get_pages(self, document_id):
         doc = self._read_document(document_id)
         if doc is not None:
-            return [
-                (pid, p['img_path'], p['dimensions'][0], p['dimensions'][1])
-                for pid, p in doc['pages'].items()]
+            return [doc.get_page(page_id) for page_id in doc.pages]
 
     def get_page(self, document_id, page_id):
         doc = self._read_document(document_id)
-        if doc is not None and page_id in doc['pages']:
-            p = doc['pages'][page_id]
-            return (page_id, p['img_path'], p['dimensions'][0],
-                    p['dimensions'][1])
+        if doc is not None:
+            return doc.get_page(page_id)
+
+
+def _thread_local():
+    """ Create storage that is local to the OS thread.
+
+    Unlike `threading.local` after gevent patched it, which is local to the
+    greenlet, so every request of a gevent worker would get its own.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return monkey.get_original('threading', 'local')()
+    return threading.local()
+
+
+def _timed_query(func):
+    """ Record the time spent in a repository method in the metrics,
+    labelled with the name of the method. """
+    return metrics.timed('hocrviewer_db_query_seconds',
+                         query=func.__name__)(func)
 
 
 class DatabaseRepository(object):
-    def __init__(self, db_path):
+    def __init__(self, db_path, search_cache_size=SEARCH_CACHE_SIZE):
         """ Local document index using SQLite.
 
+        Connections are kept open for the lifetime of the thread that
+        created them, with separate read-only connections for serving and
+        a writer connection for ingest. With gevent, all greenlets of a
+        thread share its connections.
+
         :param db_path: Path to the database file
         :type db_path:  :py:class:`pathlib.Path`
+        :param search_cache_size:   Budget in bytes for the search results
+                                    kept in memory
         """
         if not db_path.parent.exists():
             db_path.parent.mkdir(parents=True)
         init_db = not db_path.exists()
         self.db_path = db_path
+        self._local = _thread_local()
+        self._searches = MemoryCache(search_cache_size)
         if init_db:
-            with self._db as cur:
+            with self._writer as cur:
                 cur.executescript(SCHEMA)
+                cur.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        elif self.schema_version < SCHEMA_VERSION:
+            logger.warning(
+                "The database at {} was created by an older version, please "
+                "run `hocrviewer migrate` to update it.".format(db_path))
+
+    @property
+    def schema_version(self):
+        # Uses a throwaway connection, since this is called before gunicorn
+        # forks its workers
+        with closing(sqlite3.connect(str(self.db_path))) as conn:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def _connect(self, pragmas, readonly):
+        conn = sqlite3.connect(str(self.db_path),
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        try:
+            conn.execute(JOURNAL_PRAGMA)
+        except sqlite3.OperationalError:
+            if not readonly:
+                raise
+            logger.debug("Could not switch {} to WAL mode"
+                         .format(self.db_path))
+        conn.executescript(pragmas)
+        return conn
+
+    def _get_connection(self, readonly):
+        local = self._local
+        # Connections must not be shared with forked worker processes
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.reader = local.writer = None
+        if readonly:
+            if local.reader is None:
+                local.reader = self._connect(READER_PRAGMAS, readonly=True)
+            return local.reader
+        if local.writer is None:
+            local.writer = self._connect(WRITER_PRAGMAS, readonly=False)
+        return local.writer
 
     @property
     @contextmanager
     def _db(self):
-        with sqlite3.connect(str(self.db_path)) as conn:
-            cursor = conn.cursor()
+        cursor = self._get_connection(readonly=True).cursor()
+        try:
             yield cursor
+        finally:
+            cursor.close()
+
+    @property
+    @contextmanager
+    def _writer(self):
+        conn = self._get_connection(readonly=False)
+        with conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
 
-    @lru_cache(5)
-    def _get_term_frequencies(self, document_id):
+    @_timed_query
+    def document_ids(self, offset=0, limit=None):
         with self._db as cur:
-            return Counter(json.loads(gzip.decompress(
-                cur.execute("SELECT counter FROM lexica WHERE document_id = ?",
-                            (document_id,)).fetchone()[0]).decode('utf8')))
+            return [
+                r[0] for r in cur.execute(
+                    "SELECT document_id FROM documents "
+                    "ORDER BY document_id LIMIT ? OFFSET ?",
+                    (-1 if limit is None else limit, offset)).fetchall()]
 
-    def document_ids(self):
+    @_timed_query
+    def document_count(self):
         with self._db as cur:
-            return (
-                r[0] for r in
-                cur.execute("SELECT document_id FROM documents").fetchall())
+            return cur.execute(
+                "SELECT count(*) FROM documents").fetchone()[0]
 
+    def preload(self):
+        """ Nothing to prepare, connections must not be shared with forked
+        processes and are opened by every worker itself. """
+
+    def cache_stats(self):
+        """ Get the counters of the in-memory caches, see
+        :py:meth:`FilesystemRepository.cache_stats`. """
+        return {'searches': self._searches.stats()}
+
+    @_timed_query
     def get_document(self, document_id):
         with self._db as cur:
             return cur.execute(
                 "SELECT document_id, filename, metadata FROM documents "
                 "WHERE document_id = ?", (document_id,)).fetchone()
 
+    @_timed_query
+    def get_document_version(self, document_id):
+        """ Get a timestamp that changes whenever the document changes.
+
+        :returns:   Time the document was ingested or `None` if the
+                    document does not exist
+        """
+        with self._db as cur:
+            row = cur.execute(
+                "SELECT ingested_at FROM documents WHERE document_id = ?",
+                (document_id,)).fetchone()
+        if row:
+            return row[0]
+
+    @_timed_query
     def get_image_path(self, document_id, page_id):
         with self._db as cur:
             return cur.execute(
@@ -327,14 +1210,35 @@ class DatabaseRepository(object):
                 "WHERE document_id = ? AND  page_id = ?",
                 (document_id, page_id)).fetchone()[0]
 
+    @_timed_query
     def get_lines(self, document_id, page_id):
         with self._db as cur:
-            return cur.execute(
-                "SELECT text, pos_x, pos_y, width, height FROM transcriptions "
-                "WHERE document_id = ? AND page_id = ? "
-                "ORDER BY position",
-                (document_id, page_id)).fetchall()
+            return cur.execute(GET_LINES, {'document_id': document_id,
+                                           'page_id': page_id}).fetchall()
+
+    @_timed_query
+    def get_lines_range(self, document_id, start=None, end=None, limit=None):
+        """ Get the lines for a range of pages with a single query.
 
+        :param start:   First page id of the range, defaults to the first page
+        :param end:     Last page id of the range, defaults to the last page
+        :param limit:   Maximum number of pages to return
+        :returns:       List of `(page_id, lines)` tuples in page order or
+                        `None` if the document does not exist
+        """
+        if self.get_document_version(document_id) is None:
+            return None
+        with self._db as cur:
+            rows = cur.execute(GET_LINES_RANGE, {
+                'document_id': document_id,
+                'start': start or '',
+                'end': end or chr(sys.maxunicode),
+                'limit': -1 if limit is None else limit}).fetchall()
+        return [(page_id, [line[1:] for line in page_rows
+                           if line[1] is not None])
+                for page_id, page_rows in groupby(rows, key=itemgetter(0))]
+
+    @_timed_query
     def get_pages(self, document_id):
         with self._db as cur:
             return cur.execute(
@@ -343,6 +1247,7 @@ class DatabaseRepository(object):
                 "WHERE document_id = ? ORDER BY page_id",
                 (document_id,)).fetchall()
 
+    @_timed_query
     def get_page(self, document_id, page_id):
         with self._db as cur:
             return cur.execute(
@@ -351,95 +1256,444 @@ class DatabaseRepository(object):
                 "WHERE document_id = ? AND page_id = ?",
                 (document_id, page_id)).fetchone()
 
+    @_timed_query
+    def get_fingerprint(self, document_id):
+        """ Get the fingerprint the file of a document had when it was
+        ingested.
+
+        :returns:   The fingerprint or `None` if the document does not
+                    exist or was ingested before fingerprints were recorded
+        :rtype:     :py:class:`FileFingerprint`
+        """
+        with self._db as cur:
+            row = cur.execute(
+                "SELECT file_size, file_mtime, file_hash FROM documents "
+                "WHERE document_id = ?", (document_id,)).fetchone()
+        if row and row[2] is not None:
+            return FileFingerprint(*row)
+
+    def update_fingerprint(self, document_id, filename, fingerprint):
+        """ Record the file of an unchanged document, e.g. after it was
+        touched or moved, without ingesting it again. """
+        with self._writer as cur:
+            cur.execute(
+                "UPDATE documents SET filename = ?, file_size = ?, "
+                "file_mtime = ? WHERE document_id = ? AND file_hash = ?",
+                (filename, fingerprint.size, fingerprint.mtime, document_id,
+                 fingerprint.hash))
+
     def ingest_document(self, hocr_path, autocomplete_min_count=5):
-        """ Ingest a new document.
+        """ Ingest a new document or replace an existing one.
 
         :param hocr_path:   path to load document from
         :type lines:        :py:class:`pathlib.Path`
         """
-        doc_id = get_doc_id(hocr_path)
-        doc = HocrDocument(doc_id, hocr_path)
-        with self._db as cur:
-            cur.execute(
-                INSERT_DOCUMENT,
-                dict(document_id=doc_id, filename=str(hocr_path),
-                     metadata=None))
-            for page_id, dimensions, img_path, md5sum in doc.get_pages():
-                cur.execute(
-                    INSERT_PAGE,
-                    dict(page_id=page_id, document_id=doc_id,
-                         img_path=str(img_path), img_width=dimensions[0],
-                         img_height=dimensions[1], img_md5=md5sum))
-
-            for page_id, lines in doc.get_lines():
-                line_vals = (
-                    dict(document_id=doc_id, page_id=page_id,
-                         text=line_text, position=pos,
-                         word_cuts=" ".join(':'.join(c) for c in word_cuts),
-                         pos_x=x1, pos_y=y1,
-                         width=x2-x1 if x1 and x2 else None,
-                         height=y2-y1 if x1 and x2 else None)
-                    for pos, (line_text, (x1, y1, x2, y2), word_cuts)
-                    in enumerate(lines))
-                cur.executemany(INSERT_TRANSCRIPTION, line_vals)
-        self._update_search_index(doc_id, autocomplete_min_count)
-
-    def _update_search_index(self, doc_id, autocomplete_min_count):
-        # FIXME: This is a bit unwiedly and I'd prefer there was a nicely
-        #        scalable in-SQL solution, but unfortunately keeping the
-        #        term frequencies for each document in a table makes
-        #        the database size explode, so gzipped json-dumped counters
-        #        it is for now :/
+        self.store_document(extract_document(hocr_path),
+                            autocomplete_min_count)
+
+    def store_document(self, rows, autocomplete_min_count=5):
+        """ Write a document that was parsed with :py:func:`extract_document`
+        to the database.
+
+        If the document was ingested before, all of its rows are replaced in
+        the same transaction, so readers see either the old or the new
+        version.
+
+        :param rows:    Rows for the document, its pages and lines
+        :type rows:     :py:class:`DocumentRows`
+        """
+        doc_id = rows.document['document_id']
+        pages = self._fill_image_sizes(rows.pages)
+        with self._writer as cur:
+            self._delete_document(cur, doc_id)
+            cur.execute(INSERT_DOCUMENT,
+                        dict(rows.document, ingested_at=time.time()))
+            doc_rowid = cur.lastrowid
+            cur.executemany(INSERT_PAGE, pages)
+            page_texts = []
+            by_page = groupby(
+                sorted(rows.lines, key=itemgetter('page_id', 'position')),
+                key=itemgetter('page_id'))
+            for page_num, (page_id, page_lines) in enumerate(by_page):
+                page_lines = list(page_lines)
+                text, offsets = _join_lines([l['text'] for l in page_lines])
+                cur.executemany(INSERT_TRANSCRIPTION, (
+                    dict(line, text_offset=offset, text_length=length)
+                    for line, (offset, length) in zip(page_lines, offsets)))
+                page_texts.append(dict(
+                    rowid=_page_rowid(doc_rowid, page_num),
+                    document_id=doc_id, page_id=page_id, text=text,
+                    word_infos=pack_word_boxes(
+                        (l['word_cuts'], l['pos_y'], l['height'])
+                        for l in page_lines)))
+            self._update_search_index(cur, doc_id, page_texts,
+                                      autocomplete_min_count)
+
+    def _delete_document(self, cur, doc_id):
+        cur.execute(DELETE_INDEX_PAGES, (doc_id,))
+        for table in DOCUMENT_TABLES:
+            cur.execute("DELETE FROM {} WHERE document_id = ?".format(table),
+                        (doc_id,))
+
+    def _fill_image_sizes(self, pages):
+        """ Fill in the dimensions of pages that have none in the hOCR.
+
+        Dimensions that were read from an image before are taken from the
+        `pages` table if the image has not been modified since, all others
+        are read from the images concurrently.
+
+        :returns:   Copies of the page rows with dimensions
+        """
+        pages = [dict(p) for p in pages]
+        unknown = [p for p in pages if p['img_width'] is None]
+        if not unknown:
+            return pages
+        with ThreadPoolExecutor(PROBE_WORKERS) as executor:
+            mtimes = list(executor.map(
+                lambda p: os.stat(p['img_path']).st_mtime_ns, unknown))
+        unprobed = []
         with self._db as cur:
-            terms_before = Counter(dict(
-                cur.execute("SELECT term, cnt FROM text_vocab").fetchall()))
-            cur.execute(UPDATE_INDEX_SINGLE_DOCUMENT, {'document_id': doc_id})
-            terms_after = Counter(dict(
-                cur.execute("SELECT term, cnt FROM text_vocab").fetchall()))
-            doc_terms = Counter(dict(
-                (term, cnt_after - terms_before.get('term', 0))
-                for term, cnt_after in terms_after.items()
-                if cnt_after != terms_before.get('term')))
-            # Purge terms below threshold to save on size
-            to_purge = []
-            for term, cnt in doc_terms.items():
-                if cnt < autocomplete_min_count:
-                    to_purge.append(term)
-            for term in to_purge:
-                del doc_terms[term]
-            cur.execute(
-                "INSERT INTO lexica (document_id, counter) VALUES (?, ?)",
-                (doc_id, gzip.compress(json.dumps(doc_terms).encode('utf8'))))
+            for page, mtime in zip(unknown, mtimes):
+                page['img_mtime'] = mtime
+                known = cur.execute(
+                    "SELECT img_width, img_height FROM pages "
+                    "WHERE img_path = ? AND img_mtime = ? LIMIT 1",
+                    (page['img_path'], mtime)).fetchone()
+                if known:
+                    page['img_width'], page['img_height'] = known
+                else:
+                    unprobed.append(page)
+        sizes = probe_image_sizes(p['img_path'] for p in unprobed)
+        for page, (width, height) in zip(unprobed, sizes):
+            page['img_width'], page['img_height'] = width, height
+        return pages
+
+    def _update_search_index(self, cur, doc_id, page_texts,
+                             autocomplete_min_count):
+        cur.executemany(INSERT_PAGE_TEXT, page_texts)
+        cur.executemany(INSERT_INDEX_PAGE, page_texts)
+        doc_terms = self._count_terms(cur, (r['text'] for r in page_texts))
+        self._store_autocomplete(cur, doc_id, doc_terms,
+                                 autocomplete_min_count)
 
+    def _store_autocomplete(self, cur, doc_id, doc_terms,
+                            autocomplete_min_count):
+        """ Store the terms of a document for autocompletion.
+
+        All terms are kept in a table sorted by term, so that the terms for a
+        prefix form a contiguous range. Since short prefixes match large
+        parts of the vocabulary, the most frequent terms for every prefix of
+        up to `AUTOCOMPLETE_PREFIX_DEPTH` characters are precomputed.
+        """
+        # Purge terms below threshold to save on size
+        terms = sorted(((term, cnt) for term, cnt in doc_terms.items()
+                        if cnt >= autocomplete_min_count),
+                       key=lambda x: (-x[1], x[0]))
+        cur.executemany(INSERT_AUTOCOMPLETE_TERM,
+                        ((doc_id, term, cnt) for term, cnt in terms))
+        top = {}
+        for term, cnt in terms:
+            for prefix_len in range(min(len(term),
+                                        AUTOCOMPLETE_PREFIX_DEPTH) + 1):
+                ranked = top.setdefault(term[:prefix_len], [])
+                if len(ranked) < AUTOCOMPLETE_TOP_K:
+                    ranked.append((term, cnt))
+        cur.executemany(
+            INSERT_AUTOCOMPLETE_TOP,
+            ((doc_id, prefix, rank, term, cnt)
+             for prefix, ranked in top.items()
+             for rank, (term, cnt) in enumerate(ranked)))
+
+    def _count_terms(self, cur, texts):
+        """ Count the terms in `texts` as they would end up in the search
+        index, by running them through a scratch FTS table that uses the
+        same tokenizer.
+
+        :returns:   Term frequencies
+        :rtype:     :py:class:`collections.Counter`
+        """
+        for stmt in LEXICON_SCHEMA:
+            cur.execute(stmt)
+        cur.executemany("INSERT INTO temp.lexicon_idx (text) VALUES (?)",
+                        ((t,) for t in texts))
+        terms = Counter(dict(
+            cur.execute("SELECT term, cnt FROM temp.lexicon_vocab")))
+        cur.execute("DELETE FROM temp.lexicon_idx")
+        return terms
+
+    @_timed_query
     def search(self, query, document_id, limit=50):
         """ Search the index for pages matching the query.
 
+        Only the index rows of the document are visited, so the time taken
+        does not depend on how many documents are in the index. Pages are
+        ranked by their number of hits, ties are broken by page order.
+
+        Results are cached by document, query and the time the document was
+        ingested, so they are not reused once it is ingested again. Runs of
+        whitespace in the query are collapsed, they don't change its
+        meaning.
+
         :param query:   A SQLite FTS5 query
         :param document_id:     Restrict search to this document
         :param limit:   Maximum number of matches to return
-        :returns:       Generator that yields matches with their coordinates
+        :returns:       Generator that yields the page id, the highlighted
+                        page text and the :py:class:`WordBoxes` of the page
+                        for every match
         """
+        query = ' '.join(query.split())
         with self._db as cur:
-            matches = cur.execute(SEARCH_INSIDE, {'document_id': document_id,
-                                                  'query': query,
-                                                  'limit': limit}).fetchall()
-        for page_id, match_text, word_infos, score in matches:
-            line_infos = []
-            for combined in word_infos.split('||'):
-                if not combined:
-                    continue
-                winfos, linfo = combined.split('|')
-                linfo = LineInfo(*(int(x) if x != '' else -1
-                                   for x in linfo.split(':')))
-                winfos = tuple(
-                    WordInfo(*(int(x) if x != '' else -1
-                               for x in w.split(':')))
-                    for w in winfos.split(' ') if w)
-                line_infos.append((linfo, winfos))
-            yield page_id, match_text, line_infos
-
-    def autocomplete(self, query, document_id, min_cnt=1):
+            doc = cur.execute(
+                "SELECT id, ingested_at FROM documents WHERE document_id = ?",
+                (document_id,)).fetchone()
+            if doc is None:
+                return
+            doc_rowid, ingested_at = doc
+            key = (document_id, query, ingested_at, limit)
+            matches = self._searches.get(key)
+            if matches is None:
+                matches = cur.execute(SEARCH_INSIDE, {
+                    'query': query,
+                    'first_rowid': _page_rowid(doc_rowid, 0),
+                    'last_rowid': _page_rowid(doc_rowid + 1, 0) - 1
+                }).fetchall()
+                matches.sort(key=lambda m: m[1].count('<hi>'), reverse=True)
+                matches = matches[:limit]
+                self._searches.set(key, matches, sum(
+                    sys.getsizeof(match_text) + len(word_infos) +
+                    SEARCH_RESULT_OVERHEAD
+                    for _, match_text, word_infos in matches))
+        for page_id, match_text, word_infos in matches:
+            yield page_id, match_text, WordBoxes(word_infos)
+
+    @_timed_query
+    def search_corpus(self, query, limit=50, after=None, before=None):
+        """ Search the pages of all documents, ranked by bm25.
+
+        Results are paged with cursors, the `(rank, rowid)` of the last or
+        first result of a page. Every page ranks all matching pages in the
+        index, but the texts and word boxes are only read for the pages that
+        are returned.
+
+        :param query:   A SQLite FTS5 query
+        :param limit:   Maximum number of matches to return
+        :param after:   Cursor to return the matches following it
+        :param before:  Cursor to return the matches preceding it
+        :returns:       The matches and the cursors for the previous and the
+                        next page, which are `None` if there is none. Every
+                        match is a tuple of the document id, page id,
+                        highlighted page text and the :py:class:`WordBoxes`
+                        of the page.
+        """
+        # One more match than requested tells whether there is another page
+        params = {'query': query, 'limit': limit + 1}
+        condition = ''
+        if before is not None:
+            order, cursor, operator = 'DESC', before, '<'
+        else:
+            order, cursor, operator = 'ASC', after, '>'
+        if cursor is not None:
+            params['rank'], params['rowid'] = cursor
+            condition = 'AND (rank, rowid) {} (:rank, :rowid)'.format(operator)
+        with self._db as cur:
+            ranked = cur.execute(
+                SEARCH_CORPUS.format(condition=condition, order=order),
+                params).fetchall()
+            has_more = len(ranked) > limit
+            ranked = ranked[:limit]
+            if before is not None:
+                ranked.reverse()
+            rows = {}
+            if ranked:
+                rows = {row[0]: row[1:] for row in cur.execute(
+                    SEARCH_CORPUS_PAGES.format(
+                        placeholders=', '.join('?' * len(ranked))),
+                    [query] + [rowid for _, rowid in ranked])}
+        if before is not None:
+            prev_cursor = ranked[0] if has_more else None
+            next_cursor = ranked[-1] if ranked else None
+        else:
+            prev_cursor = ranked[0] if ranked and after is not None else None
+            next_cursor = ranked[-1] if has_more else None
+        matches = []
+        for _, rowid in ranked:
+            document_id, page_id, match_text, word_infos = rows[rowid]
+            matches.append((document_id, page_id, match_text,
+                            WordBoxes(word_infos)))
+        return matches, prev_cursor, next_cursor
+
+    @_timed_query
+    def autocomplete(self, query, document_id, min_cnt=1,
+                     limit=AUTOCOMPLETE_TOP_K):
+        """ Find the most frequent terms in a document that start with the
+        query.
+
+        :param query:   Prefix to complete
+        :param document_id:     Restrict completions to this document
+        :param min_cnt: Minimum frequency of returned terms
+        :param limit:   Maximum number of terms to return
+        :returns:       List of `(term, count)` tuples, most frequent first
+        """
         query = query.lower()
-        freqs = self._get_term_frequencies(document_id)
-        return ((term, freq) for term, freq in freqs.most_common()
-                if term.startswith(query) and freq >= min_cnt)
+        params = {'document_id': document_id, 'prefix': query,
+                  'min_cnt': min_cnt, 'limit': limit}
+        with self._db as cur:
+            if (len(query) <= AUTOCOMPLETE_PREFIX_DEPTH and
+                    limit <= AUTOCOMPLETE_TOP_K):
+                return cur.execute(AUTOCOMPLETE_TOP, params).fetchall()
+            params['prefix_end'] = _prefix_end(query)
+            return cur.execute(AUTOCOMPLETE_RANGE, params).fetchall()
+
+    def migrate(self, autocomplete_min_count=5):
+        """ Bring a database that was created by an older version up to date.
+
+        :param autocomplete_min_count:  Frequency threshold for terms if the
+                                        autocomplete data has to be rebuilt
+        """
+        options = {'autocomplete_min_count': autocomplete_min_count}
+        for version in range(self.schema_version + 1, SCHEMA_VERSION + 1):
+            logger.info("Migrating {} to schema version {}"
+                        .format(self.db_path, version))
+            with self._writer as cur:
+                # sqlite3 only opens a transaction implicitly before DML, the
+                # schema changes have to be part of it as well so that an
+                # interrupted migration leaves the database untouched
+                cur.execute("BEGIN")
+                getattr(self, '_migrate_v{}'.format(version))(cur, options)
+                cur.execute("PRAGMA user_version = {}".format(version))
+
+    def vacuum(self):
+        """ Rebuild the database file, e.g. to shrink it after a migration.
+        """
+        conn = self._get_connection(readonly=False)
+        conn.execute("VACUUM")
+
+    def _migrate_v1(self, cur, options):
+        # gzipped JSON counters in `lexica` -> prefix-indexed tables. The old
+        # counters held corpus-wide counts, so they're recomputed from the
+        # search index.
+        for stmt in AUTOCOMPLETE_SCHEMA:
+            cur.execute(stmt)
+        texts = cur.connection.execute(
+            "SELECT document_id, text FROM text_idx ORDER BY document_id")
+        for doc_id, rows in groupby(texts, key=itemgetter(0)):
+            doc_terms = self._count_terms(cur, (text for _, text in rows))
+            self._store_autocomplete(cur, doc_id, doc_terms,
+                                     options['autocomplete_min_count'])
+        cur.execute("DROP TABLE IF EXISTS lexica")
+
+    def _migrate_v2(self, cur, options):
+        # Timestamp of the last ingest, used to invalidate cached manifests
+        cur.execute("ALTER TABLE documents ADD COLUMN ingested_at REAL")
+        cur.execute("UPDATE documents SET ingested_at = ?", (time.time(),))
+
+    def _migrate_v3(self, cur, options):
+        for stmt in DOCUMENT_INDEXES:
+            cur.execute(stmt)
+
+    def _migrate_v4(self, cur, options):
+        # Word coordinates in the search index go from
+        # `seq:x1:x2 seq:x1:x2|y:h:pos||` strings to packed int32 arrays
+        rowids = [r[0] for r in cur.execute("SELECT rowid FROM text_idx")]
+        for rowid in rowids:
+            word_infos = cur.execute(
+                "SELECT word_infos FROM text_idx WHERE rowid = ?",
+                (rowid,)).fetchone()[0]
+            lines = []
+            for combined in (word_infos or '').split('||'):
+                if not combined.strip():
+                    continue
+                word_cuts, line_info = combined.split('|')
+                y_pos, height, _ = (int(x) if x != '' else -1
+                                    for x in line_info.split(':'))
+                lines.append((word_cuts, y_pos, height))
+            cur.execute("UPDATE text_idx SET word_infos = ? WHERE rowid = ?",
+                        (pack_word_boxes(lines), rowid))
+
+    def _migrate_v5(self, cur, options):
+        # Search index rowids are assigned per document, so the index has
+        # to be rebuilt with the new rowids
+        cur.execute(TEXT_INDEX_SCHEMA.format(
+            name='text_idx_new', content='', tokenize=FTS_TOKENIZE))
+        rows = cur.connection.execute("""
+            SELECT d.id, t.document_id, t.page_id, t.text, t.word_infos
+            FROM text_idx t
+            JOIN documents d ON d.document_id = t.document_id
+            ORDER BY d.id, t.rowid;
+        """)
+        insert_page = """
+            INSERT INTO text_idx_new (rowid, document_id, page_id, text,
+                                      word_infos)
+                VALUES (:rowid, :document_id, :page_id, :text, :word_infos);
+        """
+        for doc_rowid, doc_rows in groupby(rows, key=itemgetter(0)):
+            cur.executemany(insert_page, (
+                dict(rowid=_page_rowid(doc_rowid, page_num),
+                     document_id=doc_id, page_id=page_id, text=text,
+                     word_infos=word_infos)
+                for page_num, (_, doc_id, page_id, text, word_infos)
+                in enumerate(doc_rows)))
+        cur.execute("DROP TABLE text_vocab")
+        cur.execute("DROP TABLE text_idx")
+        cur.execute("ALTER TABLE text_idx_new RENAME TO text_idx")
+
+    def _migrate_v6(self, cur, options):
+        # The text of the search index moves to `page_texts`, the index
+        # becomes an external content table and lines refer to their text
+        # in the page text instead of storing a copy. Word coordinates are
+        # only kept in `page_texts.word_infos`.
+        cur.execute(PAGE_TEXTS_SCHEMA)
+        cur.execute("""
+            INSERT INTO page_texts (id, document_id, page_id, word_infos)
+                SELECT rowid, document_id, page_id, word_infos FROM text_idx;
+        """)
+        cur.execute("ALTER TABLE transcriptions RENAME TO transcriptions_v5")
+        cur.execute(TRANSCRIPTIONS_SCHEMA)
+        lines = cur.connection.execute("""
+            SELECT document_id, page_id, text, position, pos_x, pos_y,
+                   width, height
+            FROM transcriptions_v5
+            ORDER BY document_id, page_id, position;
+        """)
+        columns = ('document_id', 'page_id', 'text', 'position', 'pos_x',
+                   'pos_y', 'width', 'height')
+        for (doc_id, page_id), page_lines in groupby(
+                lines, key=itemgetter(0, 1)):
+            page_lines = [dict(zip(columns, l)) for l in page_lines]
+            text, offsets = _join_lines([l['text'] or ''
+                                         for l in page_lines])
+            cur.executemany(INSERT_TRANSCRIPTION, (
+                dict(line, text_offset=offset, text_length=length)
+                for line, (offset, length) in zip(page_lines, offsets)))
+            cur.execute(
+                "UPDATE page_texts SET text = ? "
+                "WHERE document_id = ? AND page_id = ?",
+                (text, doc_id, page_id))
+        cur.execute("DROP TABLE transcriptions_v5")
+        for stmt in DOCUMENT_INDEXES:
+            cur.execute(stmt)
+        cur.execute("DROP TABLE text_idx")
+        cur.execute(TEXT_INDEX_SCHEMA.format(
+            name='text_idx', content=TEXT_INDEX_CONTENT,
+            tokenize=FTS_TOKENIZE))
+        cur.execute("INSERT INTO text_idx (text_idx) VALUES ('rebuild')")
+
+    def _migrate_v7(self, cur, options):
+        # Dimensions read from page images are cached by path and mtime
+        cur.execute("ALTER TABLE pages ADD COLUMN img_mtime INTEGER")
+        cur.execute(IMAGE_SIZE_INDEX)
+
+    def _migrate_v8(self, cur, options):
+        # Fingerprints of the hOCR files for incremental indexing, existing
+        # documents have none and are ingested again by the next run
+        for column, column_type in (('file_size', 'INTEGER'),
+                                    ('file_mtime', 'INTEGER'),
+                                    ('file_hash', 'TEXT')):
+            cur.execute("ALTER TABLE documents ADD COLUMN {} {}"
+                        .format(column, column_type))
+
+    def _migrate_v9(self, cur, options):
+        # Terms are counted with a temporary vocabulary table per document,
+        # the one over the whole search index is unused. Databases that
+        # were migrated from before version 5 don't have it anymore.
+        cur.execute("DROP TABLE IF EXISTS text_vocab")
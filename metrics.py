@@ -0,0 +1,365 @@
+import fcntl
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import write_atomic
+
+#: Upper bounds in seconds of the buckets of all duration histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+#: Minimum number of seconds between two writes of the metrics of a process
+#: to the shared directory
+FLUSH_INTERVAL = 1.0
+#: File in the shared directory with the counters and histograms of all
+#: processes that have exited
+EXITED_FILENAME = 'exited.json'
+#: File in the shared directory that is locked while `EXITED_FILENAME` is
+#: updated
+LOCK_FILENAME = '.lock'
+#: Type and description of every metric, in the order they are exposed
+METRICS = (
+    ('hocrviewer_request_duration_seconds', 'histogram',
+     "Time from receiving a request until its response was sent"),
+    ('hocrviewer_responses_total', 'counter',
+     "Responses sent, by endpoint and status code"),
+    ('hocrviewer_db_query_seconds', 'histogram',
+     "Time spent in DatabaseRepository queries"),
+    ('hocrviewer_hocr_parse_seconds', 'histogram',
+     "Time spent parsing hOCR files"),
+    ('hocrviewer_cache_hits_total', 'counter', "Cache lookups that hit"),
+    ('hocrviewer_cache_misses_total', 'counter', "Cache lookups that missed"),
+    ('hocrviewer_cache_evictions_total', 'counter',
+     "Entries evicted from in-memory caches"),
+    ('hocrviewer_cache_entries', 'gauge', "Entries in in-memory caches"),
+    ('hocrviewer_cache_bytes', 'gauge',
+     "Estimated size of in-memory caches"))
+
+
+class Registry(object):
+    def __init__(self):
+        """ Metrics of a single process.
+
+        Recording a value only updates a dictionary. If a directory is
+        configured, the metrics are written to a file named after the
+        process in it at most every `FLUSH_INTERVAL` seconds, so that
+        :py:meth:`expose` can add up the metrics of all gunicorn workers.
+        The files of processes that have exited are added up into a single
+        file by the next call of :py:meth:`expose`.
+        """
+        self.directory = None
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._filename = None
+        self._flushed_at = 0
+        self._timer = None
+
+    def configure(self, directory):
+        """ Share the metrics through `directory`.
+
+        :type directory:    :py:class:`pathlib.Path`
+        """
+        self.directory = directory
+        if not directory.exists():
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def reset(self):
+        """ Remove the metrics of all processes, e.g. those of a previous
+        run of the server. """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+        for path in self._list_files():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _list_files(self):
+        if self.directory is None:
+            return []
+        try:
+            return [path for path in self.directory.iterdir()
+                    if not path.name.startswith('.')]
+        except OSError:
+            return []
+
+    def add_collector(self, collector):
+        """ Register a function that is called whenever the metrics are
+        written and returns additional samples.
+
+        :param collector:   Callable that returns `(name, labels, value)`
+                            tuples, with the labels as a dict and the
+                            current value of the counter or gauge
+        """
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        """ Increment a counter. """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Record a value in a histogram. """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                # One count per bucket, then the +Inf bucket and the sum
+                counts = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for idx, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            else:
+                counts[-2] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        """ Get the metrics of this process in the format they are shared
+        in. """
+        samples = []
+        for collector in self._collectors:
+            samples.extend((name, sorted(labels.items()), value)
+                           for name, labels, value in collector())
+        with self._lock:
+            samples.extend((name, labels, value)
+                           for (name, labels), value in self._counters.items())
+            histograms = [(name, labels, list(counts)) for (name, labels),
+                          counts in self._histograms.items()]
+        return {'samples': samples, 'histograms': histograms}
+
+    def flush(self, force=False):
+        """ Write the metrics of this process to the shared directory, if
+        the last write was more than `FLUSH_INTERVAL` seconds ago.
+
+        Otherwise the write is scheduled for when the interval has passed,
+        so the latest values are shared even if the process stays idle.
+        """
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < FLUSH_INTERVAL:
+            with self._lock:
+                if self._timer is None:
+                    self._timer = threading.Timer(
+                        FLUSH_INTERVAL, self._flush_scheduled)
+                    self._timer.daemon = True
+                    self._timer.start()
+            return
+        self._flushed_at = now
+        if self._pid != os.getpid():
+            # Forked worker, the start time tells it apart from an earlier
+            # process with the same pid
+            self._pid = os.getpid()
+            self._filename = '{}-{}.json'.format(self._pid, int(time.time()))
+        write_atomic(self.directory / self._filename,
+                     json.dumps(self.snapshot()).encode('utf8'))
+
+    def _flush_scheduled(self):
+        with self._lock:
+            self._timer = None
+        self.flush(force=True)
+
+    def _iter_snapshots(self):
+        if self.directory is None:
+            yield True, self.snapshot()
+            return
+        self.flush(force=True)
+        exited = []
+        for path in self._list_files():
+            if path.name == EXITED_FILENAME:
+                continue
+            if not _is_alive(int(path.name.split('-', 1)[0])):
+                exited.append(path)
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is not None:
+                yield True, snapshot
+        if exited:
+            self._fold_exited(exited)
+        snapshot = _read_snapshot(self.directory / EXITED_FILENAME)
+        if snapshot is not None:
+            yield False, snapshot
+
+    def _fold_exited(self, paths):
+        """ Add the counters and histograms of processes that have exited to
+        the totals in `EXITED_FILENAME` and remove their files, so that the
+        number of files does not grow as gunicorn restarts workers.
+        """
+        exited_path = self.directory / EXITED_FILENAME
+        with _locked(self.directory / LOCK_FILENAME):
+            # Files that another process folded meanwhile are gone
+            snapshots = [(False, snapshot) for snapshot
+                         in map(_read_snapshot, [exited_path] + paths)
+                         if snapshot is not None]
+            samples, histograms = _sum_snapshots(snapshots)
+            write_atomic(exited_path, json.dumps({
+                'samples': [(name, labels, value) for (name, labels), value
+                            in samples.items()],
+                'histograms': [(name, labels, counts) for (name, labels),
+                               counts in histograms.items()]
+            }).encode('utf8'))
+            for path in paths:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def expose(self):
+        """ Add up the metrics of all processes.
+
+        Counters and histograms of processes that have exited are kept, so
+        that the totals don't go down when gunicorn restarts a worker, while
+        gauges only include running processes.
+
+        :returns:   The metrics in the Prometheus text exposition format
+        :rtype:     str
+        """
+        samples, histograms = _sum_snapshots(self._iter_snapshots())
+        lines = []
+        for name, metric_type, description in METRICS:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            if metric_type != 'histogram':
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == name:
+                        lines.append('{}{} {}'.format(
+                            name, _format_labels(labels),
+                            _format_value(value)))
+                continue
+            for (sample_name, labels), counts in sorted(histograms.items()):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, cnt in zip(BUCKETS + ('+Inf',), counts[:-1]):
+                    cumulative += cnt
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels + (('le', str(bound)),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), _format_value(counts[-1])))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _sum_snapshots(snapshots):
+    """ Add up the metrics of several processes.
+
+    :param snapshots:   `(alive, snapshot)` tuples, the gauges of processes
+                        that are not alive are left out
+    :returns:           The sample values and histogram counts, by metric
+                        name and labels
+    """
+    types = {name: metric_type for name, metric_type, _ in METRICS}
+    samples = {}
+    histograms = {}
+    for alive, snapshot in snapshots:
+        for name, labels, value in snapshot['samples']:
+            if types.get(name) == 'gauge' and not alive:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            samples[key] = samples.get(key, 0) + value
+        for name, labels, counts in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(counts))
+            for idx, cnt in enumerate(counts):
+                total[idx] += cnt
+    return samples, histograms
+
+
+def _read_snapshot(path):
+    try:
+        with path.open('rb') as fp:
+            return json.loads(fp.read().decode('utf8'))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+@contextmanager
+def _locked(path):
+    """ Hold an exclusive lock on `path` for the duration of the block,
+    shared with other processes. """
+    with open(str(path), 'ab') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+#: Registry of the current process
+registry = Registry()
+
+
+def timed(name, **labels):
+    """ Decorator that records the duration of every call of a function in
+    the histogram `name`.
+
+    For generator functions, only the time spent inside the generator is
+    recorded, not the time the caller spends between items.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                gen = func(*args, **kwargs)
+                elapsed = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(gen)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    gen.close()
+                    registry.observe(name, elapsed, **labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    registry.observe(name, time.perf_counter() - start,
+                                     **labels)
+        return wrapper
+    return decorator
@@ -0,0 +1,994 @@
+from __future__ import print_function
+
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+import traceback
+import types
+import zlib
+from multiprocessing import cpu_count
+
+import flask
+import gunicorn.app.base
+from flask_iiif import IIIF
+from flask_iiif.api import IIIFImageAPIWrapper
+from flask_iiif.cache.cache import ImageCache
+from flask_restful import Api
+from PIL import Image
+from werkzeug.http import is_resource_modified
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import metrics
+from cache import write_atomic
+from index import DatabaseRepository, probe_image_size
+
+#: Maximum number of annotation lists returned by a single batch request
+MAX_BATCH_PAGES = 100
+#: Number of books listed per page on the landing page
+INDEX_PAGE_SIZE = 100
+#: Number of matching pages per page of corpus search results
+SEARCH_PAGE_SIZE = 50
+#: Number of words shown before and after every search hit
+HIT_CONTEXT_WORDS = 8
+#: Tile size and scale factors of the tiles the bundled OpenSeadragon
+#: requests. It derives 9 zoom levels from the scale factors 1-64 in
+#: flask-iiif's info.json, levels whose image fits into a single tile are
+#: requested as a whole.
+TILE_SIZE = 256
+TILE_SCALE_FACTORS = tuple(2**k for k in range(9))
+#: Widths and heights of the thumbnails requested by the bundled Mirador
+THUMBNAIL_WIDTHS = (200, 300)
+THUMBNAIL_HEIGHTS = (80, 150)
+#: Compliance level of the image service of exported books, only the tiles
+#: and thumbnails that :py:func:`render_page` pre-renders can be requested
+STATIC_IMAGE_PROFILE = 'http://iiif.io/api/image/2/level0.json'
+#: Approximate size of the pieces JSON responses are streamed in
+STREAM_CHUNK_SIZE = 64 * 1024
+#: Content codings for JSON responses, in order of preference
+CONTENT_ENCODINGS = ('gzip',) if brotli is None else ('br', 'gzip')
+#: Compression level for Brotli, the highest levels are too slow to be
+#: applied on the fly
+BROTLI_QUALITY = 5
+
+
+app = flask.Flask('hocrviewer', static_folder='./vendor/mirador',
+                  static_url_path='/static')
+ext = IIIF(app=app)
+api = Api(app=app)
+ext.init_restful(api, prefix="/iiif/image/")
+repository = None
+manifest_cache = None
+logger = logging.getLogger(__name__)
+
+
+class ApiException(Exception):
+    status_code = 500
+
+    def __init__(self, message, status_code=None, payload=None):
+        Exception.__init__(self)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        self.payload = payload
+
+    def to_dict(self):
+        rv = dict(self.payload or ())
+        rv['message'] = self.message
+        return rv
+
+
+@app.errorhandler(ApiException)
+def handle_api_exception(error):
+    response = flask.jsonify(error.to_dict())
+    response.status_code = error.status_code
+    return response
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = flask.g.request_started
+    endpoint = flask.request.endpoint or 'unmatched'
+    status = str(response.status_code)
+
+    def record():
+        metrics.registry.observe('hocrviewer_request_duration_seconds',
+                                 time.perf_counter() - started,
+                                 endpoint=endpoint)
+        metrics.registry.inc('hocrviewer_responses_total',
+                             endpoint=endpoint, status=status)
+        metrics.registry.flush()
+    if response.direct_passthrough:
+        # Files (i.e. images) are handed to the server as they are, without
+        # calling the close hooks of the response
+        record()
+    else:
+        # Called once streamed responses have been sent completely
+        response.call_on_close(record)
+    return response
+
+
+def collect_cache_stats():
+    """ Report the counters of the in-memory caches of the repository to
+    the metrics. """
+    if repository is None:
+        return
+    for cache_name, stats in repository.cache_stats().items():
+        for key in ('hits', 'misses', 'evictions'):
+            yield ('hocrviewer_cache_{}_total'.format(key),
+                   {'cache': cache_name}, stats[key])
+        yield ('hocrviewer_cache_entries', {'cache': cache_name},
+               stats['entries'])
+        yield ('hocrviewer_cache_bytes', {'cache': cache_name},
+               stats['bytes'])
+
+
+metrics.registry.add_collector(collect_cache_stats)
+
+
+def cors(origin='*'):
+    """This decorator adds CORS headers to the response"""
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            resp = flask.make_response(f(*args, **kwargs))
+            h = resp.headers
+            h['Access-Control-Allow-Origin'] = origin
+            return resp
+        return decorated_function
+    return decorator
+
+
+def locate_image(uid):
+    book_id, page_id = uid.split(':')
+    return repository.get_image_path(book_id, page_id)
+
+
+def iter_json(obj):
+    """ Serialize `obj` piece by piece, with the same output as
+    :py:func:`flask.jsonify` in production mode.
+
+    Generators are serialized as arrays, one item at a time, so that only
+    the current item has to be in memory. Dicts and lists are split up to
+    reach generators nested in them, all other values are serialized as a
+    whole.
+
+    :returns:   Generator of strings
+    """
+    if isinstance(obj, types.GeneratorType):
+        yield '['
+        for idx, item in enumerate(obj):
+            if idx:
+                yield ','
+            yield _dump_json(item)
+        yield ']'
+    elif isinstance(obj, dict):
+        yield '{'
+        for idx, key in enumerate(sorted(obj)):
+            if idx:
+                yield ','
+            yield _dump_json(key) + ':'
+            yield from iter_json(obj[key])
+        yield '}'
+    elif isinstance(obj, list):
+        yield '['
+        for idx, item in enumerate(obj):
+            if idx:
+                yield ','
+            yield from iter_json(item)
+        yield ']'
+    else:
+        yield _dump_json(obj)
+
+
+_dump_json = functools.partial(json.dumps, sort_keys=True,
+                               separators=(',', ':'))
+
+
+def _iter_chunks(pieces, size=STREAM_CHUNK_SIZE):
+    """ Join the strings from `pieces` into encoded chunks of at least `size`
+    bytes (except for the last one). """
+    buf = []
+    buf_len = 0
+    for piece in pieces:
+        buf.append(piece)
+        buf_len += len(piece)
+        if buf_len >= size:
+            yield ''.join(buf).encode('utf8')
+            buf = []
+            buf_len = 0
+    if buf:
+        yield ''.join(buf).encode('utf8')
+
+
+def _iter_mapped(data, size=STREAM_CHUNK_SIZE):
+    """ Stream a memory-mapped file in chunks of `size` bytes. """
+    try:
+        for offset in range(0, len(data), size):
+            yield data[offset:offset + size]
+    finally:
+        data.close()
+
+
+def _compress(chunks, encoding):
+    """ Apply a content coding to a stream of chunks.
+
+    :param encoding:    'gzip' or 'br'
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, flush = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield flush()
+
+
+def _tee_to_cache(cache, key, chunks):
+    """ Pass `chunks` through while storing them under `key` in `cache`.
+
+    The entry is only stored if the stream is consumed completely, e.g. not
+    if the client disconnects before.
+    """
+    with cache.writer(key) as fp:
+        for chunk in chunks:
+            fp.write(chunk)
+            yield chunk
+
+
+def get_content_encoding():
+    """ Pick the best content coding for a JSON response that the client
+    accepts.
+
+    :returns:   One of `CONTENT_ENCODINGS` or `None` for uncompressed
+                responses
+    """
+    return flask.request.accept_encodings.best_match(CONTENT_ENCODINGS)
+
+
+def stream_response(chunks, encoding=None, compress=True):
+    """ Create a streamed JSON response.
+
+    :param chunks:      Iterable of encoded chunks of the body
+    :param encoding:    Content coding of the chunks
+    :param compress:    Compress the chunks with the best content coding the
+                        client accepts, if `encoding` is not set
+    """
+    if encoding is None and compress:
+        encoding = get_content_encoding()
+        if encoding is not None:
+            chunks = _compress(chunks, encoding)
+    resp = flask.Response(flask.stream_with_context(chunks),
+                          mimetype='application/json')
+    if encoding is not None:
+        resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def json_response(obj):
+    """ Stream `obj` as JSON, compressed if the client supports it.
+
+    The response is generated while it is sent, so generators in `obj`
+    can still use the request context.
+    """
+    return stream_response(_iter_chunks(iter_json(obj)))
+
+
+def get_tile_path(pyramid_dir, uuid, region, size, rotation, quality,
+                  image_format):
+    """ Get the path of a pre-rendered image, laid out like the IIIF image
+    request URL. """
+    return (pyramid_dir / uuid / region / size / rotation /
+            '{}.{}'.format(quality, image_format))
+
+
+def iter_tile_requests(width, height, canvas_width, canvas_height):
+    """ Get the regions and sizes of the tiles and thumbnails the bundled
+    Mirador requests for an image.
+
+    :param width:           Width of the image
+    :param height:          Height of the image
+    :param canvas_width:    Width of the canvas in the manifest, which
+                            thumbnail sizes are based on
+    :param canvas_height:   Height of the canvas in the manifest
+    :returns:               Generator of `(region, size)` tuples
+    """
+    for scale_factor in TILE_SCALE_FACTORS:
+        level_width = -(-width // scale_factor)
+        level_height = -(-height // scale_factor)
+        if level_width < TILE_SIZE and level_height < TILE_SIZE:
+            yield 'full', '{},'.format(level_width)
+            continue
+        region_size = TILE_SIZE * scale_factor
+        for y in range(0, height, region_size):
+            for x in range(0, width, region_size):
+                region_width = min(region_size, width - x)
+                region_height = min(region_size, height - y)
+                yield ('{},{},{},{}'.format(x, y, region_width, region_height),
+                       '{},'.format(-(-region_width // scale_factor)))
+    thumbnail_widths = list(THUMBNAIL_WIDTHS)
+    if canvas_width and canvas_height:
+        thumbnail_widths.extend(int(h / (canvas_height / canvas_width))
+                                for h in THUMBNAIL_HEIGHTS)
+    for thumbnail_width in thumbnail_widths:
+        yield 'full', '{},'.format(thumbnail_width)
+
+
+class TileCache(ImageCache):
+    def __init__(self, disk_cache, pyramid_dir=None):
+        """ flask-iiif cache handler that stores rendered images and image
+        information in a :py:class:`cache.DiskCache`, so they are shared by
+        all worker processes and survive restarts.
+
+        Entries don't expire, they are only evicted when the cache exceeds
+        its size limit. Images rendered with `hocrviewer pretile` are served
+        from `pyramid_dir` before the cache is consulted.
+        """
+        super(TileCache, self).__init__()
+        self.disk_cache = disk_cache
+        self.pyramid_dir = pyramid_dir
+
+    def _get_pyramid_path(self, key):
+        if self.pyramid_dir is None or key.startswith('iiif:info:'):
+            return None
+        # Key format is defined by flask_iiif.restful.IIIFImageAPI
+        uuid, region, size, quality, filename = (
+            key[len('iiif:'):].rsplit('/', 4))
+        rotation, image_format = filename.rsplit('.', 1)
+        return get_tile_path(self.pyramid_dir, uuid, region, size, rotation,
+                             quality, image_format)
+
+    def get(self, key):
+        path = self._get_pyramid_path(key)
+        if path is not None:
+            try:
+                with path.open('rb') as fp:
+                    data = fp.read()
+                metrics.registry.inc('hocrviewer_cache_hits_total',
+                                     cache='pyramid')
+                return data
+            except (IOError, OSError):
+                metrics.registry.inc('hocrviewer_cache_misses_total',
+                                     cache='pyramid')
+        data = self.disk_cache.get(key)
+        if data is None:
+            metrics.registry.inc('hocrviewer_cache_misses_total',
+                                 cache='tiles')
+            return None
+        metrics.registry.inc('hocrviewer_cache_hits_total', cache='tiles')
+        # Image information is cached as text, images as bytes
+        if data[:1] == b's':
+            return data[1:].decode('utf8')
+        return data[1:]
+
+    def set(self, key, value, timeout=None):
+        if isinstance(value, str):
+            data = b's' + value.encode('utf8')
+        else:
+            data = b'b' + value
+        self.disk_cache.set(key, data)
+
+    def get_last_modification(self, key):
+        path = self._get_pyramid_path(key)
+        try:
+            mtime = path.stat().st_mtime
+        except (AttributeError, OSError):
+            mtime = self.disk_cache.get_mtime(key)
+        if mtime is not None:
+            return datetime.datetime.fromtimestamp(
+                int(mtime), datetime.timezone.utc)
+
+    def set_last_modification(self, key, last_modification=None,
+                              timeout=None):
+        # Taken from the modification time of the entry
+        pass
+
+    def delete(self, key):
+        self.disk_cache.delete(key)
+
+    def flush(self):
+        self.disk_cache.flush()
+
+
+class HocrViewerApplication(gunicorn.app.base.BaseApplication):
+    def __init__(self, app, tile_cache, options=None):
+        """ Serve the application with gunicorn.
+
+        :param options:     gunicorn settings, overriding the defaults of
+                            binding to port 5000 on all interfaces with
+                            `2 * CPUs + 1` sync workers
+        :type options:      dict
+        """
+        self.options = {'bind': '0.0.0.0:5000',
+                        'workers': cpu_count()*2+1}
+        self.options.update(options or {})
+        self.application = app
+        app.config['IIIF_CACHE_HANDLER'] = tile_cache
+        ext.uuid_to_image_opener_handler(locate_image)
+        super(HocrViewerApplication, self).__init__()
+
+    def load_config(self):
+        config = dict([(key, value) for key, value in self.options.items()
+                       if key in self.cfg.settings and value is not None])
+        for key, value in config.items():
+            self.cfg.set(key.lower(), value)
+
+    def load(self):
+        # With `preload_app` this runs in the master process before the
+        # workers are forked, otherwise once in every worker
+        repository.preload()
+        return self.application
+
+
+def build_manifest(book_id, book_path, metadata, pages, static=False):
+    """ Serialize a book as an IIIF manifest.
+
+    Produces the same output as building the manifest with iiif-prezi, but
+    the canvases are generated one at a time, see :py:func:`iter_json`.
+
+    :param pages:   List of `(page_id, img_path, width, height)` tuples
+    :param static:  Announce the level 0 image service of the tiles
+                    written by :py:func:`export_page`
+    :returns:       The manifest or `None` if the book has no pages
+    """
+    if not pages:
+        logger.error("{} has no images!".format(book_path))
+        return None
+    # `url_for` already includes the path the application is mounted under
+    manifest_url = (flask.request.host_url[:-1] +
+                    flask.url_for('get_book_manifest', book_id=book_id))
+    return {
+        '@context': 'http://iiif.io/api/presentation/2/context.json',
+        '@id': manifest_url + '/manifest.json',
+        '@type': 'sc:Manifest',
+        'description': 'Automatically generated from HOCR',
+        'label': book_id,
+        'sequences': [{
+            '@id': manifest_url + '/sequence/0.json',
+            '@type': 'sc:Sequence',
+            'canvases': (
+                build_canvas(manifest_url, book_id, page_id, idx, width,
+                             height, static)
+                for idx, (page_id, _, width, height) in enumerate(pages))}]}
+
+
+def build_canvas(manifest_url, book_id, page_id, idx, width, height,
+                 static=False):
+    base_url = flask.request.url_root[:-1]
+    canvas_id = manifest_url + '/canvas/' + page_id + '.json'
+    image_url = '{}/iiif/image/v2/{}:{}'.format(base_url, book_id, page_id)
+    return {
+        '@id': canvas_id,
+        '@type': 'sc:Canvas',
+        'height': height,
+        'images': [{
+            '@id': manifest_url + '/annotation/' + page_id + '.json',
+            '@type': 'oa:Annotation',
+            'motivation': 'sc:painting',
+            'on': canvas_id,
+            'resource': {
+                '@id': image_url + '/full/full/0/default.jpg',
+                '@type': 'dctypes:Image',
+                'format': 'image/jpeg',
+                'height': height,
+                'service': {
+                    '@context': 'http://iiif.io/api/image/2/context.json',
+                    '@id': image_url,
+                    'profile': (STATIC_IMAGE_PROFILE if static else
+                                'http://iiif.io/api/image/2/level2.json')},
+                'width': width}}],
+        'label': 'Page {}'.format(idx),
+        'otherContent': [{
+            '@id': flask.request.host_url[:-1] + flask.url_for(
+                'get_page_lines', book_id=book_id, page_id=page_id),
+            '@type': 'sc:AnnotationList',
+            'label': 'Transcribed Text'}],
+        'width': width}
+
+
+def get_canvas_id(book_id, page_id):
+    base_url = flask.request.host_url[:-1]
+    return (base_url + flask.url_for('get_book_manifest', book_id=book_id) +
+            '/canvas/' + page_id)
+
+
+def _build_manifest(book_id):
+    doc = repository.get_document(book_id)
+    if not doc:
+        raise ApiException(
+            "Could not find book with id '{}'".format(book_id), 404)
+    pages = repository.get_pages(book_id)
+    manifest = build_manifest(*doc, pages=pages)
+    if manifest is None:
+        raise ApiException(
+            "Could not build manifest for book with id '{}'"
+            .format(book_id), 404)
+    if isinstance(repository, DatabaseRepository):
+        manifest['service'] = {
+            '@context': 'http://iiif.io/api/search/1/context.json',
+            '@id': (flask.request.base_url +
+                    flask.url_for('search_in_book', book_id=book_id)),
+            'profile': 'http://iiif.io/api/search/1/search'}
+    return manifest
+
+
+def _iter_manifest_chunks(book_id, etag, encoding):
+    """ Get the serialized manifest of a book in the given content coding.
+
+    It is streamed from the manifest cache if it is there, otherwise it is
+    built (or compressed from the uncompressed version) and stored in the
+    cache while it is streamed. Errors are raised before anything is
+    streamed.
+    """
+    key = etag if encoding is None else '{}.{}'.format(etag, encoding)
+    if manifest_cache is not None:
+        data = manifest_cache.map(key)
+        if data is not None:
+            metrics.registry.inc('hocrviewer_cache_hits_total',
+                                 cache='manifests')
+            return _iter_mapped(data)
+        metrics.registry.inc('hocrviewer_cache_misses_total',
+                             cache='manifests')
+    if encoding is None:
+        chunks = _iter_chunks(iter_json(_build_manifest(book_id)))
+    else:
+        chunks = _compress(_iter_manifest_chunks(book_id, etag, None),
+                           encoding)
+    if manifest_cache is not None:
+        chunks = _tee_to_cache(manifest_cache, key, chunks)
+    return chunks
+
+
+@app.route("/iiif/<book_id>")
+@cors('*')
+def get_book_manifest(book_id):
+    version = repository.get_document_version(book_id)
+    if version is None:
+        raise ApiException(
+            "Could not find book with id '{}'".format(book_id), 404)
+    # The manifest contains absolute URLs, so it has to be cached for every
+    # URL the application is reachable under
+    base_url = flask.request.url_root[:-1]
+    etag = hashlib.sha1('{}|{}|{!r}'.format(base_url, book_id, version)
+                        .encode('utf8')).hexdigest()
+    encoding = get_content_encoding()
+    # Every content coding is a different representation with its own ETag
+    resp_etag = etag if encoding is None else '{}-{}'.format(etag, encoding)
+    last_modified = datetime.datetime.fromtimestamp(
+        version, tz=datetime.timezone.utc)
+    if not is_resource_modified(flask.request.environ, etag=resp_etag,
+                                last_modified=last_modified):
+        resp = flask.Response(status=304)
+        resp.vary.add('Accept-Encoding')
+    else:
+        resp = stream_response(
+            _iter_manifest_chunks(book_id, etag, encoding),
+            encoding=encoding, compress=False)
+    resp.set_etag(resp_etag)
+    resp.last_modified = last_modified
+    return resp
+
+
+def build_annotation_list(book_id, page_id, lines):
+    """ Serialize the lines of a page as an IIIF annotation list.
+
+    Produces the same output as building the list with iiif-prezi, but
+    without the overhead of its object graph.
+    """
+    base_url = (flask.request.url_root[:-1] + '/iiif/' + book_id + '/' +
+                page_id + '/')
+    canvas_id = get_canvas_id(book_id, page_id)
+    return {
+        '@context': 'http://iiif.io/api/presentation/2/context.json',
+        '@id': base_url + 'list/' + book_id + '/' + page_id + '.json',
+        '@type': 'sc:AnnotationList',
+        'resources': [
+            {'@id': base_url + 'annotation/line-{}.json'.format(idx),
+             '@type': 'oa:Annotation',
+             'motivation': 'sc:painting',
+             'resource': {
+                 '@type': 'cnt:ContentAsText',
+                 'format': 'text/plain',
+                 'chars': text},
+             'on': canvas_id + "#xywh={},{},{},{}".format(x, y, w, h)}
+            for idx, (text, x, y, w, h) in enumerate(lines)]}
+
+
+@app.route("/iiif/<book_id>/list/<page_id>", methods=['GET'])
+@app.route("/iiif/<book_id>/list/<page_id>.json", methods=['GET'])
+@cors('*')
+def get_page_lines(book_id, page_id):
+    lines = repository.get_lines(book_id, page_id)
+    if lines is None:
+        raise ApiException(
+            "Could not find lines for page '{}' in book '{}'"
+            .format(page_id, book_id), 404)
+    return json_response(build_annotation_list(book_id, page_id, lines))
+
+
+@app.route("/iiif/<book_id>/lists", methods=['GET'])
+@cors('*')
+def get_page_lines_batch(book_id):
+    """ Annotation lists for a range of pages, so that clients can prefetch
+    a spread or chapter in a single request.
+
+    Takes the (inclusive) `start` and `end` page ids as query parameters,
+    both are optional. At most `MAX_BATCH_PAGES` lists are returned.
+    """
+    pages = repository.get_lines_range(
+        book_id, flask.request.args.get('start'),
+        flask.request.args.get('end'), limit=MAX_BATCH_PAGES)
+    if pages is None:
+        raise ApiException(
+            "Could not find book with id '{}'".format(book_id), 404)
+    return json_response(build_annotation_list(book_id, page_id, lines)
+                         for page_id, lines in pages)
+
+
+def iter_highlights(match_text):
+    """ Find the hits in a page text that was highlighted by FTS5.
+
+    The sequence positions of the hit words are found by counting the
+    separators between the markers, instead of looking for the markers in
+    every word of the page.
+
+    :param match_text:  Page text with hits enclosed in `<hi>` and `</hi>`
+    :returns:           Generator of the sequence position of the first word
+                        of every hit, its words and the words before and
+                        after it
+    """
+    words = match_text.split()
+    # Separate the words by single spaces, so they can be counted by them
+    text = ' '.join(words)
+    last = 0
+    pos = 0
+    while True:
+        start = text.find('<hi>', pos)
+        end = text.find('</hi>', start)
+        if start < 0 or end < 0:
+            return
+        first = last + text.count(' ', pos, start)
+        last = first + text.count(' ', start, end)
+        pos = end
+        yield (first,
+               [w.replace('<hi>', '').replace('</hi>', '')
+                for w in words[first:last + 1]],
+               words[max(0, first - HIT_CONTEXT_WORDS):first],
+               words[last + 1:last + 1 + HIT_CONTEXT_WORDS])
+
+
+def iter_search_hits(book_id, matches):
+    """ Build the IIIF search hits for the matching pages of a book.
+
+    :param matches:     `(page_id, match_text, word_boxes)` tuples from
+                        :py:meth:`index.DatabaseRepository.search`
+    :returns:           Generator of hits and the list of word annotations
+                        they reference
+    """
+    for page_id, match_text, word_boxes in matches:
+        canvas_id = get_canvas_id(book_id, page_id)
+        for first, words, before, after in iter_highlights(match_text):
+            annotations = []
+            resources = []
+            for pos, chars in enumerate(words, first):
+                box = word_boxes.get(pos)
+                if box is None:
+                    continue
+                x, y, w, h = box
+                anno = {
+                    '@id': "/".join((canvas_id, 'words', str(pos))),
+                    '@type': 'oa:Annotation',
+                    'motivation': 'sc:Painting',
+                    'resource': {
+                        '@type': 'cnt:ContentAsText',
+                        'chars': chars},
+                    'on': canvas_id + "#xywh={},{},{},{}".format(x, y, w, h)}
+                annotations.append(anno['@id'])
+                resources.append(anno)
+            yield {
+                '@type': 'sc:Hit',
+                'annotations': annotations,
+                'match': " ".join(words),
+                'before': "..." + " ".join(before),
+                'after': " ".join(after) + "..."}, resources
+
+
+@app.route("/iiif/<book_id>/search", methods=['GET'])
+@cors('*')
+def search_in_book(book_id):
+    if not isinstance(repository, DatabaseRepository):
+        raise ApiException(
+                "Searching is only supported if the content has been indexed. "
+                "Please run `hocrviewer index` to do so.", 501)
+    base_url = flask.request.url_root[:-1]
+    query = flask.request.args.get('q')
+    if not query:
+        raise ApiException("Missing query parameter 'q'", 400)
+    # Built up front (at most 50 pages) so that errors are raised before
+    # the response is streamed
+    hits = list(iter_search_hits(book_id, repository.search(query, book_id)))
+    out = {
+        '@context': [
+            'http://iiif.io/api/presentation/2/context.json',
+            'http://iiif.io/api/search/1/context.json'],
+        '@id': (base_url + flask.url_for('search_in_book',
+                                         book_id=book_id) + '?q=' + query),
+        '@type': 'sc:AnnotationList',
+
+        'within': {
+            '@type': 'sc:Layer',
+            'ignored': [k for k in flask.request.args.keys() if k != 'q']
+        },
+
+        'resources': [anno for _, annos in hits for anno in annos],
+        'hits': [hit for hit, _ in hits]}
+    return json_response(out)
+
+
+def encode_search_cursor(cursor):
+    rank, rowid = cursor
+    return '{!r}:{}'.format(rank, rowid)
+
+
+def decode_search_cursor(value):
+    try:
+        rank, rowid = value.rsplit(':', 1)
+        return float(rank), int(rowid)
+    except ValueError:
+        raise ApiException("Invalid search cursor: {}".format(value), 400)
+
+
+@app.route("/iiif/search", methods=['GET'])
+@cors('*')
+def search_corpus():
+    if not isinstance(repository, DatabaseRepository):
+        raise ApiException(
+                "Searching is only supported if the content has been indexed. "
+                "Please run `hocrviewer index` to do so.", 501)
+    base_url = flask.request.url_root[:-1]
+    query = flask.request.args.get('q')
+    if not query:
+        raise ApiException("Missing query parameter 'q'", 400)
+    cursors = {key: decode_search_cursor(flask.request.args[key])
+               for key in ('after', 'before') if key in flask.request.args}
+    matches, prev_cursor, next_cursor = repository.search_corpus(
+        query, SEARCH_PAGE_SIZE, **cursors)
+
+    def page_url(**cursor):
+        return base_url + flask.url_for(
+            'search_corpus', q=query,
+            **{key: encode_search_cursor(value)
+               for key, value in cursor.items()})
+    out = {
+        '@context': [
+            'http://iiif.io/api/presentation/2/context.json',
+            'http://iiif.io/api/search/1/context.json'],
+        '@id': page_url(**cursors),
+        '@type': 'sc:AnnotationList',
+
+        'within': {
+            '@type': 'sc:Layer',
+            'first': page_url(),
+            'ignored': [k for k in flask.request.args.keys()
+                        if k not in ('q', 'after', 'before')]
+        }}
+    if prev_cursor is not None:
+        out['prev'] = page_url(before=prev_cursor)
+    if next_cursor is not None:
+        out['next'] = page_url(after=next_cursor)
+    hits = [(hit, resources)
+            for document_id, page_id, match_text, word_boxes in matches
+            for hit, resources in iter_search_hits(
+                document_id, [(page_id, match_text, word_boxes)])]
+    out['resources'] = [anno for _, annos in hits for anno in annos]
+    out['hits'] = [hit for hit, _ in hits]
+    return json_response(out)
+
+
+@app.route("/iiif/<book_id>/autocomplete", methods=['GET'])
+@cors('*')
+def autocomplete_in_book(book_id):
+    if not isinstance(repository, DatabaseRepository):
+        raise ApiException(
+                "Autocompletion is only supported if the content has been "
+                "indexed. Please run `hocrviewer index` to do so.", 501)
+    base_url = flask.request.url_root[:-1]
+    query = flask.request.args.get('q')
+    min_cnt = int(flask.request.args.get('min', '1'))
+    out = {
+        "@context": "http://iiif.io/api/search/1/context.json",
+        "@id": (base_url +
+                flask.url_for('autocomplete_in_book', book_id=book_id) +
+                "?q=" + query +
+                ('&min={}'.format(min_cnt) if min_cnt > 1 else '')),
+        "@type": "search:TermList",
+        "ignored": [k for k in flask.request.args.keys()
+                    if k not in ('q', 'min')],
+        "terms": []}
+    for term, cnt in repository.autocomplete(query, book_id, min_cnt):
+        out['terms'].append({
+            'match': term,
+            'count': cnt,
+            'url': (base_url +
+                    flask.url_for('search_in_book', book_id=book_id) +
+                    '?q=' + term)})
+    return json_response(out)
+
+
+@app.route('/')
+def index():
+    page = flask.request.args.get('page', 1, type=int)
+    num_pages = max(1, -(-repository.document_count() // INDEX_PAGE_SIZE))
+    if not 1 <= page <= num_pages:
+        flask.abort(404)
+    return flask.render_template(
+        'index.html', page=page, num_pages=num_pages,
+        book_ids=repository.document_ids(offset=(page - 1) * INDEX_PAGE_SIZE,
+                                         limit=INDEX_PAGE_SIZE))
+
+
+@app.route('/metrics')
+def get_metrics():
+    """ Metrics of all worker processes in the Prometheus text format. """
+    return flask.Response(metrics.registry.expose(),
+                          content_type='text/plain; version=0.0.4')
+
+
+@app.route('/view/<book_id>')
+def view(book_id):
+    return flask.render_template(
+        'mirador.html',
+        manifest_uri=flask.url_for('get_book_manifest', book_id=book_id))
+
+
+def render_page(args):
+    """ Render the tiles and thumbnails of a page that are missing in the
+    pyramid directory.
+
+    :returns:   `(uuid, number of rendered images, traceback)`, the number
+                is `None` if the page was already complete
+    """
+    uuid, img_path, canvas_width, canvas_height, pyramid_dir = args
+    try:
+        stat = os.stat(str(img_path))
+        marker_path = pyramid_dir / uuid / '.complete'
+        marker = '{} {}'.format(stat.st_mtime_ns, stat.st_size)
+        try:
+            if marker_path.read_text() == marker:
+                return uuid, None, None
+        except (IOError, OSError):
+            pass
+        image = Image.open(str(img_path))
+        image.load()
+        width, height = image.size
+        num_rendered = 0
+        with app.app_context():
+            for region, size in iter_tile_requests(width, height,
+                                                   canvas_width,
+                                                   canvas_height):
+                path = get_tile_path(pyramid_dir, uuid, region, size, '0',
+                                     'default', 'jpg')
+                if path.exists():
+                    continue
+                tile = IIIFImageAPIWrapper(image)
+                tile.apply_api(version='v2', region=region, size=size,
+                               rotation='0', quality='default')
+                write_atomic(path, tile.serve(image_format='jpg').getvalue())
+                num_rendered += 1
+        image.close()
+        write_atomic(marker_path, marker.encode('ascii'))
+        return uuid, num_rendered, None
+    except Exception:
+        return uuid, 0, traceback.format_exc()
+
+
+def _write_if_changed(path, data):
+    """ Write `data` to `path` with :py:func:`cache.write_atomic`, unless
+    the file already has exactly this content, so that unchanged files keep
+    their modification time and are not uploaded again by sync tools.
+
+    :returns:   Whether the file was written
+    """
+    try:
+        with path.open('rb') as fp:
+            if fp.read() == data:
+                return False
+    except (IOError, OSError):
+        pass
+    write_atomic(path, data)
+    return True
+
+
+def export_book(args):
+    """ Write the manifest and the annotation lists of a book to static
+    files, laid out like the URLs they are linked under.
+
+    The book is skipped if it was last exported with the same base URL and
+    search URL and has not changed since.
+
+    :param args:    `(book_id, output_dir, base_url, search_url)`, without
+                    a trailing slash on the URLs. The manifest links the
+                    search service of the application at `search_url`,
+                    unless it is `None`.
+    :returns:       `(book_id, pages, exported, traceback)`, with the pages
+                    as `(page_id, img_path, width, height)` tuples
+    """
+    book_id, output_dir, base_url, search_url = args
+    try:
+        version = repository.get_document_version(book_id)
+        pages = [tuple(page) for page in repository.get_pages(book_id) or []]
+        if version is None or not pages:
+            return (book_id, [], False,
+                    "Could not find any pages for book with id '{}'"
+                    .format(book_id))
+        book_dir = output_dir / 'iiif' / book_id
+        marker_path = book_dir / '.export'
+        marker = '{}|{}|{!r}'.format(base_url, search_url, version)
+        try:
+            if marker_path.read_text() == marker:
+                return book_id, pages, False, None
+        except (IOError, OSError):
+            pass
+        with app.test_request_context(base_url=base_url):
+            manifest = build_manifest(*repository.get_document(book_id),
+                                      pages=pages, static=True)
+            if search_url is not None:
+                manifest['service'] = {
+                    '@context': 'http://iiif.io/api/search/1/context.json',
+                    '@id': '{}/iiif/{}/search'.format(search_url, book_id),
+                    'profile': 'http://iiif.io/api/search/1/search'}
+            _write_if_changed(book_dir / 'manifest.json',
+                              b''.join(_iter_chunks(iter_json(manifest))))
+            for page_id, lines in repository.get_lines_range(book_id):
+                _write_if_changed(
+                    book_dir / 'list' / (page_id + '.json'),
+                    b''.join(_iter_chunks(iter_json(
+                        build_annotation_list(book_id, page_id, lines)))))
+        write_atomic(marker_path, marker.encode('utf8'))
+        return book_id, pages, True, None
+    except Exception:
+        return book_id, [], False, traceback.format_exc()
+
+
+def export_page(args):
+    """ Render the tiles and thumbnails of a page with
+    :py:func:`render_page` and write the info.json of a level 0 image
+    service that offers exactly those next to them.
+
+    :param args:    `(uuid, img_path, canvas_width, canvas_height,
+                    image_dir, base_url)`, where `image_dir` is the
+                    directory of the `iiif/image/v2` URLs
+    :returns:       Same as :py:func:`render_page`
+    """
+    uuid, img_path, _, _, image_dir, base_url = args
+    uuid, num_rendered, error = render_page(args[:5])
+    if error is not None:
+        return uuid, num_rendered, error
+    try:
+        width, height = probe_image_size(img_path)
+        info = dict(app.config['IIIF_API_INFO_RESPONSE_SKELETON']['v2'])
+        info.update({'@id': '{}/iiif/image/v2/{}'.format(base_url, uuid),
+                     'width': width, 'height': height,
+                     'profile': [STATIC_IMAGE_PROFILE]})
+        _write_if_changed(image_dir / uuid / 'info.json',
+                          _dump_json(info).encode('utf8'))
+    except Exception:
+        return uuid, num_rendered, traceback.format_exc()
+    return uuid, num_rendered, None